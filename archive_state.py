@@ -0,0 +1,199 @@
+# !/usr/bin/env python3
+
+# Import general libraries
+import os
+import re
+import sys
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+
+import storage
+
+# states an artifact can be recorded in
+COMPLETE = "complete"
+PARTIAL = "partial"
+
+# file suffixes of every artifact kind, longest first so "_chat.mp4" wins over ".mp4"
+video_kinds = [("render", "_chat.mp4"), ("info", "_info.json"), ("chat", "_chat.json"), ("srt", ".srt"), ("video", ".mp4")]
+clip_kinds = [("clip_info", "_clip_info.json"), ("clip_chat", "_clip_chat.json"), ("clip", "_clip.mp4")]
+
+# a run leases what it is working on for this long and renews its leases while it runs, another
+# run skips anything leased, and the leases of a run that crashed just run out
+lease_ttl = 10 * 60
+
+# every file is named "<YYYYMMDD THHMMSSZ> - <id> - <title>..."
+re_filename = re.compile(r'^\d{8} T\d{6}Z - ([^ ]+) - ')
+
+
+class ArchiveState(object):
+    """What has been archived, keyed by twitch video / clip id.
+
+    Every artifact (info json, video, chat, srt, render, ...) of an item is a row
+    with its path, size and state, so the scripts can look an item up instead of
+    rebuilding its filename from the current title and probing the disk. The base
+    path of an item is remembered too, so a renamed VOD keeps its old filenames.
+
+    Runs that overlap (cron starting the next one before the last is done)
+    share the database, and lease what they work on so they split the work.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items ("
+                              "item_id TEXT PRIMARY KEY, base_path TEXT, updated_at INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS artifacts ("
+                              "item_id TEXT, kind TEXT, path TEXT, size INTEGER, state TEXT, detail TEXT, "
+                              "updated_at INTEGER, PRIMARY KEY (item_id, kind))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS leases ("
+                              "lease_id TEXT PRIMARY KEY, owner TEXT, expires_at INTEGER)")
+        # leases of this run, kept alive by a heartbeat thread started with the first one
+        self.owner = socket.gethostname() + ":" + str(os.getpid()) + ":" + uuid.uuid4().hex[:8]
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def get(self, item_id, kind):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM artifacts WHERE item_id = ? AND kind = ?",
+                                    (str(item_id), kind)).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_complete(self, item_id, kind):
+        row = self.get(item_id, kind)
+        return row is not None and row["state"] == COMPLETE
+
+    def lookup(self, item_id, kind, path):
+        # state and path of an artifact, only probing the disk (at the path it would
+        # have been saved to) when it isn't recorded yet, e.g. archived before the db
+        row = self.get(item_id, kind)
+        if row is not None:
+            return row["state"], row["path"]
+        if not os.path.exists(path):
+            return None, path
+        state = info_state(path) if kind in ("info", "clip_info") else COMPLETE
+        self.record(item_id, kind, path, state=state, detail="existing")
+        return state, path
+
+    def artifacts(self, kind):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM artifacts WHERE kind = ?", (kind,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def record(self, item_id, kind, path, state=COMPLETE, detail=None):
+        size = os.path.getsize(path) if os.path.exists(path) else -1
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (str(item_id), kind, path, size, state, detail, int(time.time())))
+
+    def get_base(self, item_id):
+        with self.lock:
+            row = self.conn.execute("SELECT base_path FROM items WHERE item_id = ?", (str(item_id),)).fetchone()
+        return row["base_path"] if row is not None else None
+
+    def set_base(self, item_id, base_path):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+                              (str(item_id), base_path, int(time.time())))
+
+    def acquire(self, lease_id):
+        """Lease lease_id for this run, False if another run that is still alive holds it."""
+        now = int(time.time())
+        with self.lock, self.conn:
+            # taken over only if it is ours already or its owner stopped renewing it
+            self.conn.execute("INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(lease_id) DO UPDATE SET "
+                              "owner = excluded.owner, expires_at = excluded.expires_at "
+                              "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                              (str(lease_id), self.owner, now + lease_ttl, now))
+            row = self.conn.execute("SELECT owner FROM leases WHERE lease_id = ?", (str(lease_id),)).fetchone()
+            if row["owner"] != self.owner:
+                return False
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self._renew, daemon=True)
+                self.heartbeat.start()
+        return True
+
+    def release(self, lease_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM leases WHERE lease_id = ? AND owner = ?", (str(lease_id), self.owner))
+
+    def _renew(self):
+        while not self.stopped.wait(lease_ttl / 4):
+            with self.lock, self.conn:
+                self.conn.execute("UPDATE leases SET expires_at = ? WHERE owner = ?",
+                                  (int(time.time()) + lease_ttl, self.owner))
+
+    def close(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+            self.conn.close()
+
+
+def info_state(path):
+    # an info json counts as partial while lookups that failed still need to be retried
+    try:
+        info = storage.load_json(path)
+    except (IOError, OSError, ValueError):
+        return PARTIAL
+    if "moments" in info and len(info["moments"]) == 0:
+        return PARTIAL
+    if "video_offset" in info and info["video_offset"] == -1:
+        return PARTIAL
+    return COMPLETE
+
+
+def rebuild(state, path_root, kinds):
+    # walk the archive once and record every artifact found in it
+    count = 0
+    for subdir, dirs, files in os.walk(path_root):
+        for file in files:
+            match = re_filename.match(file)
+            if match is None:
+                continue
+            for kind, suffix in kinds:
+                if file.endswith(suffix):
+                    path = os.path.join(subdir, file)
+                    if state.get_base(match.group(1)) is None:
+                        state.set_base(match.group(1), path[:-len(suffix)])
+                    item_state = info_state(path) if kind in ("info", "clip_info") else COMPLETE
+                    state.record(match.group(1), kind, path, state=item_state, detail="rebuild")
+                    count = count + 1
+                    break
+    return count
+
+
+if __name__ == "__main__":
+
+    import yaml  # pip install PyYAML
+
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("usage: " + sys.argv[0] + " rebuild")
+        exit(-1)
+
+    # find the archive folders the same way the scripts do
+    path_base = os.path.dirname(os.path.abspath(__file__))
+    with open(path_base + "/config/config.yaml") as f:
+        conf = yaml.load(f, Loader=yaml.FullLoader)
+    path_cache = path_base + conf.get("cache_dir", "/cache/")
+    os.makedirs(path_cache, exist_ok=True)
+    state = ArchiveState(path_cache + "archive_state.db")
+
+    for config_name, root_key, kinds in [("videos.yaml", "video_downloads", video_kinds),
+                                         ("clips.yaml", "clip_downloads", clip_kinds)]:
+        if not os.path.exists(path_base + "/config/" + config_name):
+            continue
+        with open(path_base + "/config/" + config_name) as f:
+            path_root = yaml.load(f, Loader=yaml.FullLoader)[root_key]
+        t0 = time.time()
+        count = rebuild(state, path_root, kinds)
+        print("recorded " + str(count) + " files from " + path_root + " in " + str(time.time() - t0) + " seconds")
+    state.close()
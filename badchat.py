@@ -0,0 +1,61 @@
+# Import general libraries
+import os
+import time
+
+import utils
+
+# wait a day before trying a failed chat again, doubling every time it fails, up to a month
+retry_after_base = 24 * 60 * 60
+retry_after_max = 30 * 24 * 60 * 60
+
+
+class BadChatCache(object):
+    """Ids whose chat download failed, with why, when and when to try again.
+
+    Replaces the old badchat.videos / badchat.clips flat files. The entries are
+    kept in a dict so a lookup is an exact match on the id instead of scanning
+    the whole file. The old file is imported the first time the cache is used.
+    """
+
+    def __init__(self, path, legacy_path=None):
+        new_store = not os.path.exists(path)
+        self.store = utils.JsonStore(path)
+        if new_store and legacy_path is not None and os.path.exists(legacy_path):
+            self.import_legacy(legacy_path)
+
+    def import_legacy(self, legacy_path):
+        # one id per line, all we know is that it failed before the file was last touched
+        failed_at = int(os.path.getmtime(legacy_path))
+        with open(legacy_path) as f:
+            ids = set(line.strip() for line in f if line.strip() != "")
+        self.store.update(dict((id, {
+            "reason": "imported from " + os.path.basename(legacy_path),
+            "first_failed": failed_at,
+            "last_failed": failed_at,
+            "attempts": 1,
+            "retry_after": failed_at + retry_after_base,
+        }) for id in ids))
+        print("imported " + str(len(ids)) + " bad chat ids from " + legacy_path)
+
+    def should_skip(self, id):
+        entry = self.store.get(id)
+        return entry is not None and time.time() < entry["retry_after"]
+
+    def get(self, id):
+        return self.store.get(id)
+
+    def add(self, id, reason):
+        # read and written as one step, another run may have failed on the same id since we looked
+        def failed(entry):
+            now = int(time.time())
+            entry = entry if entry is not None else {"first_failed": now, "attempts": 0}
+            entry["reason"] = reason
+            entry["last_failed"] = now
+            entry["attempts"] = entry["attempts"] + 1
+            backoff = min(retry_after_base * 2 ** (entry["attempts"] - 1), retry_after_max)
+            entry["retry_after"] = now + backoff
+            return entry
+        return self.store.modify(id, failed)
+
+    def remove(self, id):
+        self.store.delete(id)
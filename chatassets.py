@@ -0,0 +1,96 @@
+# Import general libraries
+import os
+import json
+import hashlib
+
+import chatjson
+import storage
+
+# top level field a dehydrated chat file lists its assets in, in front of the comments
+assets_field = "embeddedAssets"
+
+
+def asset_hash(item):
+    return hashlib.sha256(json.dumps(item, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def asset_path(path_store, digest):
+    return os.path.join(path_store, digest[:2], digest + ".json")
+
+
+def is_dehydrated(path_chat):
+    with chatjson.ChatReader(path_chat) as reader:
+        return assets_field in reader.header()
+
+
+def store_asset(path_store, item):
+    # content addressed, an asset already in the store is never written again
+    digest = asset_hash(item)
+    path = asset_path(path_store, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(item, f)
+        os.replace(path + ".tmp", path)
+    return digest
+
+
+def dehydrate(path_chat, path_store):
+    """Move the embedded emotes, badges and bits of a chat file into the store.
+
+    embeddedData is set to null and the hashes of its items are listed in the
+    header instead, so chatrender still works on the file, just without the
+    embedded images. Returns the number of bytes saved, None if there was nothing to do.
+    """
+    # first pass, the embedded data comes after the comments
+    with chatjson.ChatReader(path_chat) as reader:
+        if assets_field in reader.header():
+            return None
+        for comment in reader.comments():
+            pass
+        embedded = reader.fields.get("embeddedData")
+    if not embedded:
+        return None
+    assets = {}
+    for key, items in embedded.items():
+        if isinstance(items, list):
+            assets[key] = [store_asset(path_store, item) for item in items]
+        else:
+            assets[key] = items
+
+    # second pass, copy the comments over with the references in the header
+    size_before = os.path.getsize(path_chat)
+    with chatjson.ChatReader(path_chat) as reader:
+        header = dict(reader.header())
+        header[assets_field] = assets
+        writer = chatjson.ChatWriter(path_chat + ".tmp", header, storage.compression)
+        for comment in reader.comments():
+            writer.write(comment)
+        trailer = dict((key, value) for key, value in reader.fields.items() if key not in header)
+    trailer["embeddedData"] = None
+    writer.close(trailer)
+    os.replace(path_chat + ".tmp", path_chat)
+    return size_before - os.path.getsize(path_chat)
+
+
+def rehydrate(path_chat, path_out, path_store):
+    # write a copy of a dehydrated chat file with its embedded data put back, for chatrender
+    with chatjson.ChatReader(path_chat) as reader:
+        header = dict(reader.header())
+        assets = header.pop(assets_field, {})
+        writer = chatjson.ChatWriter(path_out, header)
+        for comment in reader.comments():
+            writer.write(comment)
+        trailer = dict((key, value) for key, value in reader.fields.items()
+                       if key not in header and key != assets_field)
+    embedded = {}
+    for key, digests in assets.items():
+        if not isinstance(digests, list):
+            embedded[key] = digests
+            continue
+        embedded[key] = []
+        for digest in digests:
+            with open(asset_path(path_store, digest), encoding="utf-8") as f:
+                embedded[key].append(json.load(f))
+    trailer["embeddedData"] = embedded
+    writer.close(trailer)
@@ -0,0 +1,238 @@
+# Import general libraries
+import json
+
+import storage
+
+# how much of a chat file is read at a time
+chunk_size = 1 << 20
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\r\n"
+
+
+class ChatReader(object):
+    """Reads a TDCLI chat json without loading all of its comments at once.
+
+    The top level fields are decoded one at a time. header() returns the fields
+    in front of the comments, comments() then yields the comments one by one,
+    and once it is done the fields after them (embeddedData) are in fields too.
+    """
+
+    def __init__(self, path):
+        self.file = storage.open_read(path)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.fields = {}
+        self.at_comments = False
+        self.done = False
+        self._expect("{")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _fill(self, size=chunk_size):
+        if self.eof:
+            return False
+        data = self.file.read(size)
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos = self.pos + 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos] if self.pos < len(self.buffer) else ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("expected '" + char + "' in chat json, got '" + self._peek() + "'")
+        self.pos = self.pos + 1
+
+    def _value(self):
+        # decode the next value, reading more (twice as much each time) until it is complete
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number right at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill(max(chunk_size, len(self.buffer) - self.pos))
+
+    def _next_field(self):
+        # read "key": and return the key, or None at the end of the object
+        char = self._peek()
+        if char == ",":
+            self.pos = self.pos + 1
+            char = self._peek()
+        if char == "}":
+            self.pos = self.pos + 1
+            return None
+        key = self._value()
+        self._expect(":")
+        return key
+
+    def header(self):
+        while not self.at_comments and not self.done:
+            key = self._next_field()
+            if key is None:
+                self.done = True
+            elif key == "comments":
+                self.at_comments = True
+            else:
+                self.fields[key] = self._value()
+        return self.fields
+
+    def comments(self):
+        self.header()
+        if self.at_comments:
+            self._expect("[")
+            first = True
+            while True:
+                char = self._peek()
+                if char == "]":
+                    self.pos = self.pos + 1
+                    break
+                if not first:
+                    self._expect(",")
+                first = False
+                yield self._value()
+            self.at_comments = False
+            self.header()
+
+
+class ChatWriter(object):
+    """Writes a chat json in the same layout, comments are added one at a time.
+
+    The file is plain json unless a compression ("gzip" / "zstd") is given.
+    """
+
+    def __init__(self, path, header, compression=None):
+        self.file = storage.open_write(path, compression)
+        self.file.write("{")
+        for key, value in header.items():
+            self.file.write(json.dumps(key) + ":" + json.dumps(value) + ",")
+        self.file.write('"comments":[')
+        self.count = 0
+
+    def write(self, comment):
+        if self.count > 0:
+            self.file.write(",")
+        self.file.write(json.dumps(comment))
+        self.count = self.count + 1
+
+    def close(self, trailer):
+        self.file.write("]")
+        for key, value in trailer.items():
+            self.file.write("," + json.dumps(key) + ":" + json.dumps(value))
+        self.file.write("}")
+        self.file.close()
+
+
+def _embedded_key(item):
+    # emotes have an id, badges and cheermotes go by name (or prefix)
+    for key in ("id", "name", "prefix"):
+        if isinstance(item, dict) and key in item:
+            return key + ":" + str(item[key])
+    return json.dumps(item, sort_keys=True)
+
+
+def merge_embedded(merged, embedded):
+    # union of the embedded emotes / badges of several chat files
+    if embedded is None:
+        return merged
+    if merged is None:
+        merged = {}
+    for key, items in embedded.items():
+        if not isinstance(items, list):
+            merged.setdefault(key, items)
+            continue
+        current = merged.setdefault(key, [])
+        seen = set(_embedded_key(item) for item in current)
+        for item in items:
+            if _embedded_key(item) not in seen:
+                seen.add(_embedded_key(item))
+                current.append(item)
+    return merged
+
+
+def merge_ranges(paths, ranges, path_out, overlap=60):
+    """Merge the chat files of consecutive time ranges of one vod into one file.
+
+    A comment near a boundary can be in both neighbouring files, so the ids of
+    the comments in the last overlap seconds of a range are kept and skipped in
+    the next one. Only those ids and the embedded data are held in memory.
+    """
+    if len(paths) == 0:
+        raise ValueError("no chat files to merge")
+    header = None
+    writer = None
+    embedded = None
+    previous_tail = set()
+    for i, path in enumerate(paths):
+        tail = set()
+        next_start = ranges[i + 1][0] if i + 1 < len(ranges) else None
+        with ChatReader(path) as reader:
+            if writer is None:
+                header = dict(reader.header())
+                header.pop("embeddedData", None)
+                if isinstance(header.get("video"), dict):
+                    header["video"]["start"] = ranges[0][0]
+                    header["video"]["end"] = ranges[-1][1]
+                writer = ChatWriter(path_out, header)
+            for comment in reader.comments():
+                comment_id = comment.get("_id")
+                if comment_id in previous_tail:
+                    continue
+                if next_start is not None and comment.get("content_offset_seconds", 0) >= next_start - overlap:
+                    tail.add(comment_id)
+                writer.write(comment)
+            embedded = merge_embedded(embedded, reader.fields.get("embeddedData"))
+            trailer = dict((key, value) for key, value in reader.fields.items() if key not in header)
+        previous_tail = tail
+    trailer["embeddedData"] = embedded
+    writer.close(trailer)
+    return writer.count
+
+
+def slice_range(path, path_out, begin, end, video=None, compression=None):
+    """Write the comments of a vod chat file between begin and end seconds as a chat file of its own.
+
+    Offsets are rebased so the slice starts at 0, the way a clip chat from
+    chatdownload does, and the fields in video are put over the parent's
+    video header. The parent is streamed, only the embedded data is held in
+    memory. Returns the number of comments written.
+    """
+    with ChatReader(path) as reader:
+        header = dict(reader.header())
+        header.pop("embeddedData", None)
+        header["video"] = dict(header.get("video") or {})
+        header["video"].update({"start": 0, "end": end - begin, "length": end - begin})
+        if video is not None:
+            header["video"].update(video)
+        writer = ChatWriter(path_out, header, compression)
+        for comment in reader.comments():
+            offset = comment.get("content_offset_seconds", 0)
+            # the comments are in order, but the embedded data after them is still needed
+            if begin <= offset <= end:
+                comment["content_offset_seconds"] = round(offset - begin, 3)
+                writer.write(comment)
+        trailer = dict((key, value) for key, value in reader.fields.items() if key not in header)
+    writer.close(trailer)
+    return writer.count
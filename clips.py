@@ -1,21 +1,39 @@
 # !/usr/bin/env python3
 
-import twitch  # pip install python-twitch-client
 import yaml  # pip install PyYAML
 
 import os
-import json
 import sys
 import time
 import subprocess
 import utils
+import http_client
+import helix
+import badchat
+import chatjson
+import chatassets
+import storage
+import archive_state
 import datetime
 import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 # importing static-ffmpeg and pre-downloading
 import static_ffmpeg
 static_ffmpeg.add_paths()
 
+# a normal run only asks for clips created since the last run, --full looks at the whole
+# num_days_to_query window again to catch clips that went over min_view_counts later on
+parser = argparse.ArgumentParser(description="archive the most viewed clips of each channel")
+parser.add_argument("--full", action="store_true",
+                    help="query all num_days_to_query days instead of only what is new since the last run")
+parser.add_argument("--refresh-views", action="store_true",
+                    help="only update the view counts (and missing vod offsets) of every archived clip, then exit")
+parser.add_argument("--verify-derived", type=int, nargs="?", const=20, default=None, metavar="N",
+                    help="download the originals of N clips that were cut from archived vods and compare durations, then exit")
+args = parser.parse_args()
+
 # authentication information
 path_base = os.path.dirname(os.path.abspath(__file__))
 config_file = path_base + "/config/config.yaml"
@@ -23,6 +41,8 @@ with open(config_file) as f:
     conf = yaml.load(f, Loader=yaml.FullLoader)
 client_id = conf["client_id"]
 client_secret = conf["client_secret"]
+storage.configure(conf)
+http_client.configure(conf)
 
 clips_config = path_base + "/config/clips.yaml"
 with open(clips_config) as g:
@@ -30,6 +50,22 @@ with open(clips_config) as g:
 channels = clips["channels"]
 min_view_counts = clips["min_view_counts"]
 num_days_to_query = clips["num_days_to_query"]
+cursor_overlap_hours = clips.get("cursor_overlap_hours", 6)
+refresh_workers = clips.get("refresh_workers", 4)
+
+# cut clips out of vods videos.py already archived (by the state database) instead of downloading them
+derive_from_vods = clips.get("derive_from_vods", False)
+# take the chat of clips out of the chat videos.py archived with the vod instead of downloading it
+slice_chat_from_vods = clips.get("slice_chat_from_vods", False)
+
+# move the embedded emotes/badges of chat files into a store shared by the channel (<channel>/.assets/)
+chat_asset_store = clips.get("chat_asset_store", False)
+
+# helix stops listing clips after about 1000 results, a window that gets this many above the
+# view threshold is split in half (down to window_min_hours) and the halves are queried again
+window_saturation = clips.get("window_saturation", 900)
+window_min_hours = clips.get("window_min_hours", 1)
+window_workers = clips.get("window_workers", 4)
 
 # number of days to try to request
 date_start = (datetime.datetime.now()-datetime.timedelta(days=num_days_to_query)).strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -41,6 +77,7 @@ print("End Day: "+date_end)
 #   A full path is needed for TwitchDownloader
 
 ffmpeg_path = shutil.which('ffmpeg')
+ffprobe_path = shutil.which('ffprobe')
 
 # ================================================================
 # ================================================================
@@ -50,8 +87,21 @@ tdcli = conf["twitchdownloader"]
 path_twitch_cli = path_base + tdcli
 path_root = clips["clip_downloads"]
 badchat_log = clips["clip_downloads"] + "badchat.clips"
+badchat_cache = badchat.BadChatCache(badchat_log + ".json", badchat_log)
 path_temp = clips["clip_temp"]
 
+# what has already been archived, by clip id, so we don't have to probe every file on every run
+path_cache = path_base + conf.get("cache_dir", "/cache/")
+os.makedirs(path_cache, exist_ok=True)
+archive = archive_state.ArchiveState(path_cache + "archive_state.db")
+
+# end of the window each channel was last queried up to, so the next run can start there
+clip_cursors = utils.JsonStore(path_cache + "clip_cursors.json")
+
+# one helix client for every channel, its app token is kept between runs
+helix_client = helix.HelixClient(client_id, client_secret, path_cache + "helix_token.json")
+game_cache = helix.GameCache(path_cache + "games.json", helix_client)
+
 # ================================================================
 # ================================================================
 
@@ -59,9 +109,7 @@ path_temp = clips["clip_temp"]
 utils.setup_signal_handle()
 
 # convert the usernames to ids (sort so the are in the same order)
-client_helix = twitch.TwitchHelix(client_id=client_id, client_secret=client_secret)
-client_helix.get_oauth()
-users_tmp = client_helix.get_users(login_names=channels)
+users_tmp = helix_client.request(lambda client: client.get_users(login_names=channels))
 users = []
 for channel in channels:
     for user in users_tmp:
@@ -69,12 +117,235 @@ for channel in channels:
             users.append(user)
             break
 
+
+def refresh_clip_infos():
+    # look every archived clip up again, 100 ids per helix request, and rewrite the
+    # info files whose view count changed or whose vod offset can now be filled in
+    rows = [row for row in archive.artifacts("clip_info") if os.path.exists(row["path"])]
+    clip_ids = [row["item_id"] for row in rows]
+    print("refreshing " + str(len(clip_ids)) + " archived clips")
+
+    def fetch(chunk):
+        if utils.terminated_requested:
+            return []
+        try:
+            return helix_client.request(lambda client: client.get_clips(clip_ids=chunk))
+        except Exception as e:
+            print(e)
+            return []
+
+    view_counts = {}
+    chunks = [clip_ids[i:i + 100] for i in range(0, len(clip_ids), 100)]
+    with ThreadPoolExecutor(max_workers=max(1, refresh_workers)) as executor:
+        for found in executor.map(fetch, chunks):
+            for clip in found:
+                view_counts[clip['id']] = clip['view_count']
+    partial = [row["item_id"] for row in rows if row["state"] == archive_state.PARTIAL]
+    clip_datas = utils.get_clip_data_batch(partial) if len(partial) > 0 and not utils.terminated_requested else {}
+
+    count_updated = 0
+    for row in rows:
+        if utils.terminated_requested:
+            break
+        video_info = storage.load_json(row["path"])
+        changed = False
+        if row["item_id"] in view_counts and video_info["view_count"] != view_counts[row["item_id"]]:
+            video_info["view_count"] = view_counts[row["item_id"]]
+            changed = True
+        clip_data = clip_datas.get(row["item_id"])
+        if clip_data is not None and clip_data['offset'] != -1 and video_info["video_offset"] == -1:
+            video_info["video_offset"] = clip_data['offset']
+            video_info["duration"] = clip_data['duration']
+            changed = True
+        if changed:
+            storage.write_json(row["path"], video_info)
+            archive.record(row["item_id"], "clip_info", row["path"],
+                           state=archive_state.info_state(row["path"]), detail="refresh")
+            count_updated = count_updated + 1
+    print("updated " + str(count_updated) + " clip info files, " + str(len(clip_ids) - len(view_counts))
+          + " clips were not returned by twitch")
+
+
+if args.refresh_views:
+    t0 = time.time()
+    refresh_clip_infos()
+    print("total execution time: " + str(time.time() - t0))
+    http_client.print_stats()
+    exit(0)
+
+def derive_clip(file_path_info, file_path_out):
+    # cut the clip out of its archived vod with a stream copy, returns False if it can't be done
+    if ffmpeg_path is None or not os.path.exists(file_path_info):
+        return False
+    info = storage.load_json(file_path_info)
+    if info["video_offset"] == -1 or info["video_id"] in (None, ""):
+        return False
+    parent = archive.get(info["video_id"], "video")
+    if parent is None or parent["state"] != archive_state.COMPLETE or not os.path.exists(parent["path"]):
+        return False
+    # start on the keyframe at or before the clip, so the copy doesn't begin with broken frames
+    start = utils.keyframe_before(parent["path"], info["video_offset"], ffprobe_path)
+    length = info["video_offset"] - start + info["duration"]
+    print("\t- cutting clip from vod " + str(info["video_id"]) + " at " + str(info["video_offset"]) + " seconds")
+    proc = subprocess.run([ffmpeg_path, "-nostdin", "-loglevel", "error", "-y", "-ss", str(start), "-i", parent["path"],
+                           "-t", str(length), "-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero", file_path_out],
+                          stdout=subprocess.DEVNULL)
+    if proc.returncode != 0 or not os.path.exists(file_path_out):
+        return False
+    # a vod that was cut short (or an offset that is off) gives a clip that is too short
+    duration = utils.get_media_duration(file_path_out, ffprobe_path)
+    if 0 <= duration < info["duration"] - 1:
+        print("\t- cut clip is only " + str(duration) + " of " + str(info["duration"]) + " seconds, downloading it instead")
+        os.remove(file_path_out)
+        return False
+    return True
+
+
+def vod_asset_store(video_id, path_chat):
+    # where videos.py put the emotes and badges of a vod chat, <channel>/.assets/ for chats
+    # dehydrated before that was recorded (the chat itself is in <channel>/<YYYY-MM>/)
+    row = archive.get(video_id, "assets")
+    if row is not None:
+        return row["path"]
+    return os.path.join(os.path.dirname(os.path.dirname(path_chat)), ".assets")
+
+
+def slice_clip_chat(file_path_info, file_path_out):
+    # write the part of the archived vod chat the clip covers, returns False if it can't be done
+    if not os.path.exists(file_path_info):
+        return False
+    info = storage.load_json(file_path_info)
+    if info["video_offset"] == -1 or info["video_id"] in (None, ""):
+        return False
+    parent = archive.get(info["video_id"], "chat")
+    if parent is None or parent["state"] != archive_state.COMPLETE or not os.path.exists(parent["path"]):
+        return False
+    begin = info["video_offset"]
+    end = info["video_offset"] + info["duration"]
+    file_path_slice = file_path_out + ".slice"
+    try:
+        # a chat downloaded for only part of the vod has to cover the clip
+        with chatjson.ChatReader(parent["path"]) as reader:
+            video = reader.header().get("video") or {}
+            dehydrated = chatassets.assets_field in reader.header()
+        if video.get("start", 0) > begin or (video.get("end") is not None and video["end"] < end):
+            return False
+        print("\t- slicing chat from vod " + str(info["video_id"]) + " at " + str(begin) + " seconds")
+        count = chatjson.slice_range(parent["path"], file_path_slice, begin, end,
+                                     video={"id": str(info["id"]), "title": info["title"]})
+        if dehydrated:
+            # put the vod's emotes and badges back from the channel store videos.py moved them to
+            chatassets.rehydrate(file_path_slice, file_path_out, vod_asset_store(info["video_id"], parent["path"]))
+            os.remove(file_path_slice)
+        else:
+            os.replace(file_path_slice, file_path_out)
+    except Exception as e:
+        print("\t- ERR: could not slice the chat from the vod, downloading it instead: " + str(e))
+        for path in (file_path_slice, file_path_out):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+    print("\t- " + str(count) + " chat messages in the clip")
+    return True
+
+
+def verify_derived_clips(limit):
+    # download the originals of clips we cut ourselves and compare how long they are
+    rows = [row for row in archive.artifacts("clip") if row["detail"] == "derived" and os.path.exists(row["path"])]
+    print("verifying " + str(min(limit, len(rows))) + " of " + str(len(rows)) + " clips cut from vods")
+    differences = []
+    for row in rows[:limit]:
+        if utils.terminated_requested:
+            break
+        file_path_original = path_temp + str(row["item_id"]) + "_original.mp4"
+        cmd = path_twitch_cli + ' clipdownload' \
+              + ' --id ' + str(row["item_id"]) \
+              + ' -o ' + file_path_original
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        proc.wait()
+        if proc.returncode != 0 or not os.path.exists(file_path_original):
+            print("\t- " + str(row["item_id"]) + ": could not download the original")
+            continue
+        duration_original = utils.get_media_duration(file_path_original, ffprobe_path)
+        duration_derived = utils.get_media_duration(row["path"], ffprobe_path)
+        os.remove(file_path_original)
+        if duration_original < 0 or duration_derived < 0:
+            print("\t- " + str(row["item_id"]) + ": could not read the durations")
+            continue
+        # the cut starts on the keyframe before the clip, so it can be up to a keyframe interval longer
+        difference = duration_derived - duration_original
+        differences.append(difference)
+        print("\t- " + str(row["item_id"]) + ": " + str(duration_derived) + " seconds cut, "
+              + str(duration_original) + " seconds original (" + "%+.2f" % difference + ")")
+    if len(differences) > 0:
+        print("compared " + str(len(differences)) + " clips, differences from %+.2f to %+.2f seconds"
+              % (min(differences), max(differences)))
+
+
+if args.verify_derived is not None:
+    os.makedirs(path_temp, exist_ok=True)
+    verify_derived_clips(args.verify_derived)
+    exit(0)
+
+
+def list_clip_window(user_id, start, end, min_views, split):
+    # clips of one window with at least min_views, and whether the window hit the listing limit
+    # a window that can still be split stops listing as soon as it saturates
+    # NOTE: twitch api seems to return in largest view count to smallest
+    # NOTE: thus once we hit our viewcount limit just stop...
+    vid_iter = helix_client.request(lambda client: client.get_clips(broadcaster_id=user_id, page_size=100,
+                                                                    started_at=start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                                                    ended_at=end.strftime('%Y-%m-%dT%H:%M:%SZ')))
+    found = []
+    checked = 0
+    for video in vid_iter:
+        checked = checked + 1
+        if video['view_count'] < min_views:
+            break
+        found.append(video)
+        if split and len(found) >= window_saturation:
+            break
+    return found, checked, len(found) >= window_saturation
+
+
+def list_clips(user_id, started_at, ended_at, min_views):
+    # all clips above min_views created between the two times, most viewed first
+    # the range is split into smaller windows whenever one saturates, each round of windows
+    # is queried at the same time and a clip on a window edge is only kept once
+    windows = [(datetime.datetime.strptime(started_at, '%Y-%m-%dT%H:%M:%SZ'),
+                datetime.datetime.strptime(ended_at, '%Y-%m-%dT%H:%M:%SZ'))]
+    clips_by_id = {}
+    checked = 0
+    with ThreadPoolExecutor(max_workers=max(1, window_workers)) as executor:
+        while len(windows) > 0 and not utils.terminated_requested:
+            splits = [end - start > datetime.timedelta(hours=window_min_hours) for start, end in windows]
+            results = list(executor.map(lambda args: list_clip_window(user_id, args[0][0], args[0][1], min_views, args[1]),
+                                        zip(windows, splits)))
+            next_windows = []
+            for (start, end), split, (found, count, saturated) in zip(windows, splits, results):
+                checked = checked + count
+                if saturated and split:
+                    middle = start + (end - start) / 2
+                    next_windows += [(start, middle), (middle, end)]
+                    continue
+                if saturated:
+                    print("\t- WARNING: " + str(len(found)) + " clips between " + str(start) + " and " + str(end)
+                          + ", some might be missing")
+                for video in found:
+                    clips_by_id[video['id']] = video
+            if len(next_windows) > 0:
+                print("\t- splitting into " + str(len(next_windows)) + " smaller windows")
+            windows = next_windows
+    arr_clips = sorted(clips_by_id.values(), key=lambda video: video['view_count'], reverse=True)
+    return arr_clips, checked
+
+
 # now lets loop through each user and make sure we have downloaded
 # their most recent VODs and if we have not, we should download them!
 t0 = time.time()
-gameid2name = {}
 count_total_clips_checked = 0
 count_total_clips_downloaded = 0
+count_total_clips_derived = 0
 for idx, user in enumerate(users):
 
     # check if we should download any more
@@ -92,135 +363,169 @@ for idx, user in enumerate(users):
     # get the videos for this specific user
     try:
         print("getting clips for -> " + user["login"] + " (id " + str(user["id"]) + ")")
-        client_helix = twitch.TwitchHelix(client_id=client_id, client_secret=client_secret)
-        client_helix.get_oauth()
-        vid_iter = client_helix.get_clips(broadcaster_id=user["id"], page_size=100,
-                                          started_at=date_start, ended_at=date_end)
-        # vid_iter = client_helix.get_clips(broadcaster_id=user["id"], page_size=100)
-        # arr_clips = []
-
-        for video in vid_iter[:]:
+        # start a little before where the last run stopped, clips show up in the api with a delay
+        started_at = date_start
+        cursor = clip_cursors.get(str(user["id"]))
+        if not args.full and cursor is not None:
+            cursor_start = datetime.datetime.strptime(cursor, '%Y-%m-%dT%H:%M:%SZ') - datetime.timedelta(hours=cursor_overlap_hours)
+            started_at = max(date_start, cursor_start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            print("\t- only clips since " + started_at)
+        arr_clips, count_checked = list_clips(user["id"], started_at, date_end, min_view_counts[idx])
+        count_total_clips_checked = count_total_clips_checked + count_checked
+        for video in arr_clips:
+            # a clip we've seen before keeps the filenames it was first saved under
+            if archive.get_base(video['id']) is None:
+                archive.set_base(video['id'], path_data + str(video['created_at'].strftime('%Y%m%d T%H%M%SZ')) + " - " + str(video['id']) + " - " + utils.cleanFilename(str(video['title'])))
+
+        # names of all the games of these clips in as few requests as possible
+        game_cache.prefetch([video['game_id'] for video in arr_clips])
+
+        # have to call the graphql api to get where the clips are in their VODs
+        # resolve all new clips, and the ones that failed before, in a few batched requests
+        unresolved = [video['id'] for video in arr_clips
+                      if archive.lookup(video['id'], "clip_info", archive.get_base(video['id']) + "_clip_info.json")[0] != archive_state.COMPLETE]
+        clip_datas = utils.get_clip_data_batch(unresolved) if len(unresolved) > 0 else {}
+        all_downloaded = True
+
+        for video in arr_clips:
 
             # check if we should download any more
             if utils.terminated_requested:
                 print('terminate requested, not downloading any more..')
                 break
             # time.sleep(random.uniform(0.0, 0.5))
-            count_total_clips_checked = count_total_clips_checked + 1
-
-            # don't download any videos below our viewcount threshold
-            # NOTE: twitch api seems to return in largest view count to smallest
-            # NOTE: thus once we hit our viewcount limit just stop...
-            if video['view_count'] < min_view_counts[idx]:
-                # print("skipping " + video['url'] + " (only " + str(video['view_count']) + " views)")
-                # continue
-                break
 
-            # nice debug print
-            # arr_clips.append(video)
-            print("processing " + video['url'] + " (" + str(video['view_count']) + " views)")
-
-            # INFO: always save to file so our viewcount gets updated!
-            # INFO: we only update the viewcount, as when the VOD gets deleted most elements are lost
-            file_path_info = path_data + str(video['created_at'].strftime('%Y%m%d T%H%M%SZ')) + " - " +  str(video['id']) + " - " + utils.cleanFilename(str(video['title']))  + "_clip_info.json"
-            if not utils.terminated_requested and not os.path.exists(file_path_info):
-                print("\t- saving clip info: " + file_path_info)
-
-                # load the game information if we don't have it
-                # note sometimes game_id isn't defined (unlisted)
-                # in this case just report an empty game
-                if video['game_id'] not in gameid2name:
-                    game = client_helix.get_games(game_ids=[video['game_id']])
-                    if len(game) > 0 and video['game_id'] == game[0]['id']:
-                        gameid2name[game[0]['id']] = game[0]['name']
-                        game_title = gameid2name[video['game_id']]
-                    else:
-                        game_title = ""
-                else:
-                    game_title = gameid2name[video['game_id']]
-
-                # have to call the graphql api to get where the clip is in the VOD
-                clip_data = utils.get_clip_data(video['id'])
-
-                # finally write to file
-                data = {
-                    'id': video['id'],
-                    'video_id': video['video_id'],
-                    'video_offset': clip_data['offset'],
-                    'creator_id': video['creator_id'],
-                    'creator_name': video['creator_name'],
-                    'title': video['title'],
-                    'game_id': video['game_id'],
-                    'game': game_title,
-                    'url': video['url'],
-                    'view_count': video['view_count'],
-                    'duration': clip_data['duration'],
-                    'created_at': video['created_at'].strftime('%Y-%m-%d %H:%M:%SZ'),
-                    'created_at_iso': video['created_at'].strftime('%Y%m%d T%H%M%SZ')
-                }
-                with open(file_path_info, 'w', encoding="utf-8") as file:
-                    json.dump(data, file, indent=4)
-
-            # elif not utils.terminated_requested:
-            #     print("\t- updating clip info: " + str(video['view_count']) + " views")
-            #     with open(file_path_info) as f:
-            #         video_info = json.load(f)
-            #     # update view count
-            #     video_info["view_count"] = video['view_count']
-            #     # update clip location if failed before
-            #     if video_info["video_offset"] == -1:
-            #         clip_data = utils.get_clip_data(video['id'])
-            #         if clip_data['offset'] != -1:
-            #             video_info["video_offset"] = clip_data['offset']
-            #             video_info["duration"] = clip_data['duration']
-            #     # finally write to file
-            #     with open(file_path_info, 'w', encoding="utf-8") as file:
-            #         json.dump(video_info, file, indent=4)
-
-
-            # VIDEO: check if the file exists
-            file_path = path_data + str(video['created_at'].strftime('%Y%m%d T%H%M%SZ')) + " - " + str(video['id']) + " - " + utils.cleanFilename(str(video['title']))  + "_clip.mp4"
-            file_path_tmp = path_temp + str(video['id']) + ".mp4"
-
-            if not utils.terminated_requested and not os.path.exists(file_path):
-                print("\t- download clip: " + str(video['id']))
-                cmd = path_twitch_cli + ' clipdownload' \
-                      + ' --id ' + str(video['id']) \
-                      + ' -o ' + file_path_tmp
-                      #+ ' --temp-path "' + path_root + '/TEMP/" --quality 1080p60 -o ' + file_path
-                # print("\t- CMD: " + str(cmd))
-                # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-                subprocess.Popen(cmd, shell=True).wait()
-                shutil.move(file_path_tmp, file_path) 
-                count_total_clips_downloaded = count_total_clips_downloaded + 1
-
-            # CHAT: check if the file exists
-            file_path_chat = path_data + str(video['created_at'].strftime('%Y%m%d T%H%M%SZ')) + " - " + str(video['id']) + " - " + utils.cleanFilename(str(video['title']))  + "_clip_chat.json"
-            file_bad = file_path_chat + ".BAD"
-            file_path_chat_tmp = path_temp + str(video['id']) + "_chat.json"
-            if utils.checkBadChat(video['id'], "clips", badchat_log) or os.path.exists(file_path_chat):
-                print("\t- chat file exists - Skipping Chat download")
-            else:
-                if not utils.terminated_requested:
-                    print("\t- download chat: " + str(video['id']) + "_chat.json")
-                    cmd = path_twitch_cli + ' chatdownload' \
+            # a run cron started while the last one is still going leaves its clips to it
+            if not archive.acquire(str(video['id']) + "/clip"):
+                print("skipping " + video['url'] + ", another run is archiving it")
+                all_downloaded = False
+                continue
+
+            try:
+                # nice debug print
+                print("processing " + video['url'] + " (" + str(video['view_count']) + " views)")
+
+                clip_base = archive.get_base(video['id'])
+
+                # INFO: always save to file so our viewcount gets updated!
+                # INFO: we only update the viewcount, as when the VOD gets deleted most elements are lost
+                info_state, file_path_info = archive.lookup(video['id'], "clip_info", clip_base + "_clip_info.json")
+                if not utils.terminated_requested and info_state is None:
+                    print("\t- saving clip info: " + file_path_info)
+
+                    # the names of every game in the window were looked up in one go already
+                    game_title = game_cache.name(video['game_id'])
+
+                    clip_data = clip_datas[video['id']]
+
+                    # finally write to file
+                    data = {
+                        'id': video['id'],
+                        'video_id': video['video_id'],
+                        'video_offset': clip_data['offset'],
+                        'creator_id': video['creator_id'],
+                        'creator_name': video['creator_name'],
+                        'title': video['title'],
+                        'game_id': video['game_id'],
+                        'game': game_title,
+                        'url': video['url'],
+                        'view_count': video['view_count'],
+                        'duration': clip_data['duration'],
+                        'created_at': video['created_at'].strftime('%Y-%m-%d %H:%M:%SZ'),
+                        'created_at_iso': video['created_at'].strftime('%Y%m%d T%H%M%SZ')
+                    }
+                    storage.write_json(file_path_info, data)
+                    archive.record(video['id'], "clip_info", file_path_info,
+                                   state=archive_state.PARTIAL if clip_data['offset'] == -1 else archive_state.COMPLETE,
+                                   detail="download")
+
+                # view counts of archived clips are updated in bulk by "clips.py --refresh-views"
+                elif not utils.terminated_requested and info_state == archive_state.PARTIAL:
+                    # fill in the clip location if it failed before
+                    clip_data = clip_datas[video['id']]
+                    if clip_data['offset'] != -1:
+                        print("\t- updating clip location: " + str(clip_data['offset']) + " seconds into " + str(clip_data['vod_id']))
+                        video_info = storage.load_json(file_path_info)
+                        video_info["video_offset"] = clip_data['offset']
+                        video_info["duration"] = clip_data['duration']
+                        storage.write_json(file_path_info, video_info)
+                        archive.record(video['id'], "clip_info", file_path_info, detail="update")
+
+                # VIDEO: check if the file exists
+                clip_state, file_path = archive.lookup(video['id'], "clip", clip_base + "_clip.mp4")
+                file_path_tmp = path_temp + str(video['id']) + ".mp4"
+
+                if not utils.terminated_requested and clip_state is None and derive_from_vods \
+                        and derive_clip(file_path_info, file_path_tmp):
+                    shutil.move(file_path_tmp, file_path)
+                    archive.record(video['id'], "clip", file_path, detail="derived")
+                    count_total_clips_derived = count_total_clips_derived + 1
+                elif not utils.terminated_requested and clip_state is None:
+                    print("\t- download clip: " + str(video['id']))
+                    cmd = path_twitch_cli + ' clipdownload' \
                           + ' --id ' + str(video['id']) \
-                          + ' -E' + ' -o ' + file_path_chat_tmp
+                          + ' -o ' + file_path_tmp
+                          #+ ' --temp-path "' + path_root + '/TEMP/" --quality 1080p60 -o ' + file_path
                     # print("\t- CMD: " + str(cmd))
-
-                    # Attempt to download chat log. If it does not exist, TDCLI will produce a non-zero exit code. We create a placeholder file with a .BAD extension to bypass future file checks
-                    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
+                    proc = subprocess.Popen(cmd, shell=True)
                     proc.wait()
-                    if proc.returncode != 0:
-                        print("\t- ERR: Clip has no chat. Either nothing was said or the source VOD is no longer available. Inserting placeholder.")               
-                        with open(badchat_log, 'a') as fp:
-                            fp.write(str(video['id']))
-                            fp.write('\n')
+                    if proc.returncode == 0 and os.path.exists(file_path_tmp):
+                        shutil.move(file_path_tmp, file_path)
+                        archive.record(video['id'], "clip", file_path, detail="download")
+                        count_total_clips_downloaded = count_total_clips_downloaded + 1
                     else:
-                        print("\t- GOOD: File moved")
-                        shutil.move(file_path_chat_tmp, file_path_chat)
+                        all_downloaded = False
+
+                # CHAT: check if the file exists
+                chat_state, file_path_chat = archive.lookup(video['id'], "clip_chat", clip_base + "_clip_chat.json")
+                file_path_chat_tmp = path_temp + str(video['id']) + "_chat.json"
+                if chat_state is not None:
+                    print("\t- chat file exists - Skipping Chat download")
+                # the vod chat on disk is tried first, the bad chat backoff is only for chatdownload
+                elif not utils.terminated_requested and slice_chat_from_vods \
+                        and slice_clip_chat(file_path_info, file_path_chat_tmp):
+                    badchat_cache.remove(video['id'])
+                    storage.publish(file_path_chat_tmp, file_path_chat)
+                    if chat_asset_store:
+                        chatassets.dehydrate(file_path_chat, path_data + ".assets/")
+                    archive.record(video['id'], "clip_chat", file_path_chat, detail="sliced")
+                elif badchat_cache.should_skip(video['id']):
+                    print("\t- chat known bad (" + badchat_cache.get(video['id'])['reason'] + ") - Skipping Chat download")
                 else:
-                    print("\t - chat download SKIPPED")
+                    if not utils.terminated_requested:
+                        print("\t- download chat: " + str(video['id']) + "_chat.json")
+                        cmd = path_twitch_cli + ' chatdownload' \
+                              + ' --id ' + str(video['id']) \
+                              + ' -E' + ' -o ' + file_path_chat_tmp
+                        # print("\t- CMD: " + str(cmd))
+
+                        # Attempt to download chat log. If it does not exist, TDCLI will produce a non-zero exit code. We remember the clip in the
+                        #   bad chat cache so it is only retried after a backoff
+                        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                        proc.wait()
+                        if proc.returncode != 0 and not utils.terminated_requested:
+                            entry = badchat_cache.add(video['id'], "chatdownload exited with " + str(proc.returncode))
+                            print("\t- ERR: Clip has no chat. Either nothing was said or the source VOD is no longer available. Attempt "
+                                  + str(entry['attempts']) + ", skipping it until "
+                                  + datetime.datetime.fromtimestamp(entry['retry_after']).strftime('%Y-%m-%d %H:%M'))
+                        elif proc.returncode == 0:
+                            print("\t- GOOD: File moved")
+                            badchat_cache.remove(video['id'])
+                            storage.publish(file_path_chat_tmp, file_path_chat)
+                            if chat_asset_store:
+                                chatassets.dehydrate(file_path_chat, path_data + ".assets/")
+                            archive.record(video['id'], "clip_chat", file_path_chat, detail="download")
+                    else:
+                        print("\t - chat download SKIPPED")
+            finally:
+                archive.release(str(video['id']) + "/clip")
+
+        # only move the cursor once everything in the window is archived, else the next run looks again
+        if all_downloaded and not utils.terminated_requested:
+            # another run that overlapped may have got further, the cursor never goes back
+            clip_cursors.modify(str(user["id"]),
+                                lambda current: date_end if current is None or date_end > current else current)
 
         # # loop through each and download
         # for video in arr_clips:
@@ -247,4 +552,7 @@ for idx, user in enumerate(users):
 t1 = time.time()
 print("number of checked clips: " + str(count_total_clips_checked))
 print("number of downloaded clips: " + str(count_total_clips_downloaded))
+print("number of clips cut from vods: " + str(count_total_clips_derived))
 print("total execution time: " + str(t1 - t0))
+archive.close()
+http_client.print_stats()
@@ -0,0 +1,158 @@
+# Import general libraries
+import os
+import time
+import threading
+import requests
+import twitch  # pip install python-twitch-client
+
+import utils
+import http_client
+
+# app access tokens come from here, module level so it can be pointed at a local server
+oauth_url = "https://id.twitch.tv/oauth2/token"
+# get a new token this long before the old one expires
+expiry_margin = 10 * 60
+
+
+class HelixClient(object):
+    """One TwitchHelix client for the whole process.
+
+    The app access token is kept on disk with when it expires, so a cron run
+    reuses the token of the previous run instead of asking for a new one. A
+    call that comes back 401 gets a fresh token and is tried once more.
+    """
+
+    def __init__(self, client_id, client_secret, path_token):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.path_token = path_token
+        self.lock = threading.Lock()
+        self.store = utils.JsonStore(path_token)
+        self.client = None
+        self.token = None
+
+    def _request_token(self):
+        response = http_client.post(oauth_url, params={"client_id": self.client_id,
+                                                       "client_secret": self.client_secret,
+                                                       "grant_type": "client_credentials"})
+        response.raise_for_status()
+        data = response.json()
+        entry = {"access_token": data["access_token"],
+                 "expires_at": int(time.time()) + int(data.get("expires_in", 0))}
+        self.store.set(self.client_id, entry)
+        # the token is as good as the client secret, keep it private
+        os.chmod(self.path_token, 0o600)
+        print("got a new twitch app token, expires in " + str(data.get("expires_in", 0)) + " seconds")
+        return entry
+
+    def _set_token(self, stale_token=None):
+        # lock held, a token other than the one that failed is one another thread already refreshed
+        entry = self.store.get(self.client_id)
+        if entry is None or entry["access_token"] == stale_token \
+                or entry["expires_at"] - expiry_margin < time.time():
+            entry = self._request_token()
+        if entry["access_token"] != self.token:
+            self.token = entry["access_token"]
+            self.client = twitch.TwitchHelix(client_id=self.client_id, oauth_token=self.token,
+                                             client_secret=self.client_secret)
+
+    def refresh(self, stale_token):
+        with self.lock:
+            self._set_token(stale_token)
+            return self.client
+
+    def request(self, fn):
+        """fn(client), with one retry on a new token if twitch says the token is no good."""
+        with self.lock:
+            if self.client is None:
+                self._set_token()
+            client, token = self.client, self.token
+        try:
+            return fn(client)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+        return fn(self.refresh(token))
+
+    def live_user_ids(self, user_ids, chunk_size=100):
+        # which of the users are streaming right now, helix takes up to 100 user ids per call
+        # and with a page as big as the chunk every live stream is on the first page
+        live = set()
+        user_ids = [str(user_id) for user_id in user_ids]
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            streams = self.request(lambda client: client.get_streams(user_ids=chunk, page_size=chunk_size)[:])
+            for stream in streams:
+                live.add(str(stream["user_id"]))
+        return live
+
+    def videos_by_id(self, video_ids, chunk_size=100):
+        # the videos of video_ids that are still there, helix takes up to 100 ids per call
+        # and answers 404 when none of them are
+        videos = []
+        video_ids = [str(video_id) for video_id in video_ids]
+        for i in range(0, len(video_ids), chunk_size):
+            chunk = video_ids[i:i + chunk_size]
+            try:
+                videos.extend(self.request(lambda client: client.get_videos(video_ids=chunk)))
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+        return videos
+
+
+# names of games are kept for a month, ids twitch didn't know are asked again after a day
+game_ttl = 30 * 24 * 60 * 60
+game_missing_ttl = 24 * 60 * 60
+
+
+class GameCache(object):
+    """Game id to name, shared by clips.py and videos.py and kept on disk.
+
+    Ids are looked up 100 at a time, and ids twitch returned nothing for are
+    remembered too so they aren't asked for on every clip.
+    """
+
+    def __init__(self, path, helix_client):
+        self.store = utils.JsonStore(path)
+        self.helix_client = helix_client
+
+    def _fresh(self, game_id):
+        entry = self.store.get(game_id)
+        if entry is None:
+            return False
+        ttl = game_ttl if entry["name"] is not None else game_missing_ttl
+        return time.time() < entry["checked"] + ttl
+
+    def prefetch(self, game_ids):
+        missing = sorted(set(str(game_id) for game_id in game_ids
+                             if game_id not in (None, "") and not self._fresh(str(game_id))))
+        for i in range(0, len(missing), 100):
+            chunk = missing[i:i + 100]
+            try:
+                games = self.helix_client.request(lambda client: client.get_games(game_ids=chunk))
+            except Exception as e:
+                print(e)
+                continue
+            now = int(time.time())
+            entries = dict((game_id, {"name": None, "checked": now}) for game_id in chunk)
+            for game in games:
+                entries[str(game["id"])] = {"name": game["name"], "checked": now}
+            self.store.update(entries)
+
+    def seed(self, names):
+        # names we got for free from somewhere else, e.g. the moments of a vod
+        now = int(time.time())
+        entries = dict((str(game_id), {"name": name, "checked": now}) for game_id, name in names.items()
+                       if game_id not in (None, "", "-1") and not self._fresh(str(game_id)))
+        if len(entries) > 0:
+            self.store.update(entries)
+
+    def name(self, game_id):
+        # note sometimes game_id isn't defined (unlisted), in this case just report an empty game
+        if game_id in (None, ""):
+            return ""
+        if not self._fresh(str(game_id)):
+            self.prefetch([game_id])
+        entry = self.store.get(str(game_id))
+        return entry["name"] if entry is not None and entry["name"] is not None else ""
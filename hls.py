@@ -0,0 +1,246 @@
+# Import general libraries
+import os
+import re
+import json
+import time
+import random
+import shutil
+import threading
+import subprocess
+from urllib.parse import urljoin, urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import http_client
+
+# where twitch hands out the playlists of a vod, module level so it can be pointed at a local server
+usher_url = "https://usher.ttvnw.net/vod/"
+client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+
+re_attribute = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class HostLimiter(object):
+    """Spaces out the requests to each host to at most per_second a second."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_time = {}
+
+    def wait(self, url):
+        if self.interval <= 0:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time.get(host, 0.0))
+            self.next_time[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def vod_playlist_url(video_id):
+    # a vod playlist needs a playback token, the same one the web player asks for
+    query = 'query { videoPlaybackAccessToken(id: ' + json.dumps(str(video_id)) \
+            + ', params: {platform: "web", playerBackend: "mediaplayer", playerType: "site"}) { value signature } }'
+    response = http_client.post(utils.gql_url, json={'query': query}, headers={"Client-ID": client_id})
+    response.raise_for_status()
+    token = response.json()["data"]["videoPlaybackAccessToken"]
+    if token is None:
+        raise ValueError("no playback token for vod " + str(video_id))
+    return usher_url + str(video_id) + ".m3u8?" + "&".join([
+        "sig=" + token["signature"], "token=" + quote(token["value"], safe=""),
+        "allow_source=true", "allow_audio_only=true", "player=twitchweb", "p=" + str(random.randint(0, 999999))])
+
+
+def parse_playlist(text, base_url):
+    """The variants of a master playlist, or the init section and segments of a media playlist.
+
+    Returns (variants, init, segments), variants as (bandwidth, url) and
+    segments as (url, duration), urls made absolute against base_url.
+    """
+    variants = []
+    segments = []
+    init = None
+    attributes = None
+    duration = 0.0
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = dict(re_attribute.findall(line[len("#EXT-X-STREAM-INF:"):]))
+        elif line.startswith("#EXT-X-MAP:"):
+            init = urljoin(base_url, dict(re_attribute.findall(line[len("#EXT-X-MAP:"):]))["URI"].strip('"'))
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",")[0])
+        elif line == "" or line.startswith("#"):
+            continue
+        elif attributes is not None:
+            variants.append((int(attributes.get("BANDWIDTH", 0)), urljoin(base_url, line)))
+            attributes = None
+        else:
+            segments.append((urljoin(base_url, line), duration))
+            duration = 0.0
+    return variants, init, segments
+
+
+def media_playlist(url):
+    # follow a master playlist to its best variant (the source quality has the highest bandwidth)
+    response = http_client.get(url)
+    response.raise_for_status()
+    variants, init, segments = parse_playlist(response.text, response.url)
+    if len(variants) > 0:
+        return media_playlist(max(variants)[1])
+    return init, segments
+
+
+def fetch(url, path, limiter):
+    # one segment into path, written under another name first so a file at path is always whole
+    if os.path.exists(path):
+        return
+    limiter.wait(url)
+    response = http_client.get(url, stream=True)
+    # muted parts of a vod are only there as "-muted" once twitch has processed them
+    if response.status_code == 403 and "-unmuted" in url:
+        response.close()
+        limiter.wait(url)
+        response = http_client.get(url.replace("-unmuted", "-muted"), stream=True)
+    try:
+        response.raise_for_status()
+        with open(path + ".part", "wb") as f:
+            for chunk in response.iter_content(1 << 16):
+                f.write(chunk)
+    finally:
+        response.close()
+    os.replace(path + ".part", path)
+
+
+def load_progress(path_progress, path_joined):
+    # how many segments are safely in the joined file, bytes a run wrote after its last checkpoint are cut off
+    progress = {"parts": 0, "size": 0}
+    if os.path.exists(path_progress) and os.path.exists(path_joined):
+        with open(path_progress, encoding="utf-8") as f:
+            progress = json.load(f)
+    if os.path.exists(path_joined):
+        with open(path_joined, "r+b") as f:
+            f.truncate(progress["size"])
+    return progress
+
+
+def join_batch(ffmpeg_path, init_path, parts, path_joined, log):
+    """Append a batch of segments to the joined mpegts file, fed through ffmpeg's stdin as they arrive.
+
+    parts yields the path of each segment in order once it is downloaded, or
+    None if it couldn't be. Returns the paths that made it into the file and
+    whether the whole batch did. Timestamps are copied from the vod, so the
+    batches of one or several runs line up in the joined file.
+    """
+    fed = []
+    complete = True
+    with open(path_joined, "ab") as out:
+        proc = subprocess.Popen([ffmpeg_path, "-loglevel", "error", "-copyts", "-i", "pipe:0",
+                                 "-map", "0", "-c", "copy", "-f", "mpegts", "pipe:1"],
+                                stdin=subprocess.PIPE, stdout=out)
+        try:
+            # fragmented mp4 segments can't be read without their init section, every ffmpeg gets it first
+            if init_path is not None:
+                with open(init_path, "rb") as f:
+                    shutil.copyfileobj(f, proc.stdin, 1 << 20)
+            for path in parts:
+                if path is None:
+                    complete = False
+                    break
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, proc.stdin, 1 << 20)
+                fed.append(path)
+            proc.stdin.close()
+        except BrokenPipeError:
+            complete = False
+        proc.wait()
+    if proc.returncode != 0:
+        log("\t- ERR: ffmpeg exited with " + str(proc.returncode) + " while joining the segments")
+        return [], False
+    return fed, complete
+
+
+def download(playlist_url, file_path_out, temp_dir, ffmpeg_path, workers=4, per_host=10, batch=100, log=print):
+    """Download a hls playlist into file_path_out, True once it is there.
+
+    Segments are fetched workers at a time, at most two per worker ahead of
+    the one ffmpeg needs next, and fed to it in order as they arrive. ffmpeg
+    appends them to a mpegts file in temp_dir (mpegts can be appended to, an
+    mp4 can't), which is checkpointed after every batch segments. Only then
+    are the segments of that batch deleted, so next to the joined file there
+    are at most batch segments plus the look ahead. An interrupted download
+    picks up at the checkpoint, and segments fetched past it are kept too.
+    At the end the joined file is copied into the mp4 and removed.
+    """
+    init, segments = media_playlist(playlist_url)
+    if len(segments) == 0:
+        log("\t- ERR: playlist has no segments")
+        return False
+    os.makedirs(temp_dir, exist_ok=True)
+    limiter = HostLimiter(per_host)
+    path_joined = temp_dir + "joined.ts"
+    path_progress = temp_dir + "joined.json"
+    init_path = temp_dir + "init.mp4" if init is not None else None
+    parts = [(url, temp_dir + "seg" + format(i, "05") + os.path.splitext(urlsplit(url).path)[1])
+             for i, (url, duration) in enumerate(segments)]
+    progress = load_progress(path_progress, path_joined)
+    if progress["parts"] > 0:
+        log("\t- resuming download, " + str(progress["parts"]) + " of " + str(len(parts)) + " segments already joined")
+
+    def fetch_part(part):
+        if utils.terminated_requested:
+            return None
+        try:
+            fetch(part[0], part[1], limiter)
+            return part[1]
+        except Exception as e:
+            log("\t- ERR: segment " + os.path.basename(part[1]) + ": " + str(e))
+            return None
+
+    if init is not None and fetch_part((init, init_path)) is None:
+        return False
+    ahead = 2 * max(1, workers)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {}
+
+        def arrived(first, last):
+            # the segments first..last-1 in order, each once it is downloaded, with the next ones queued behind
+            for i in range(first, last):
+                for k in range(i, min(i + ahead, len(parts))):
+                    if k not in pending:
+                        pending[k] = pool.submit(fetch_part, parts[k])
+                yield pending.pop(i).result()
+
+        while progress["parts"] < len(parts):
+            first = progress["parts"]
+            fed, complete = join_batch(ffmpeg_path, init_path, arrived(first, min(first + batch, len(parts))),
+                                       path_joined, log)
+            if len(fed) > 0:
+                progress = {"parts": first + len(fed), "size": os.path.getsize(path_joined)}
+                utils.write_json_atomic(path_progress, progress)
+                for path in fed:
+                    os.remove(path)
+            if not complete:
+                for future in pending.values():
+                    future.cancel()
+                if len(fed) == 0:
+                    load_progress(path_progress, path_joined)
+                log("\t- stopped at segment " + str(progress["parts"]) + " of " + str(len(parts))
+                    + ", the next run goes on from there")
+                return False
+
+    # the joined file is as big as the vod, for a moment it is there twice while it is copied into the mp4
+    proc = subprocess.Popen([ffmpeg_path, "-nostdin", "-loglevel", "error", "-y", "-i", path_joined,
+                             "-map", "0", "-c", "copy", file_path_out])
+    proc.wait()
+    if proc.returncode != 0 or not os.path.exists(file_path_out):
+        log("\t- ERR: ffmpeg exited with " + str(proc.returncode) + " while writing the mp4")
+        return False
+    os.remove(path_joined)
+    os.remove(path_progress)
+    if init_path is not None:
+        os.remove(init_path)
+    return True
@@ -0,0 +1,148 @@
+# Import general libraries
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+# how many connections to keep open to each host, requests past that wait for a free one
+max_per_host = 8
+# (connect, read) timeout in seconds
+timeout = (10, 60)
+# seconds to wait for a free connection when all max_per_host are in use, before giving up with an error
+pool_timeout = 120
+# retries after the first attempt, backing off base * 2^n seconds (with jitter) up to max
+retries = 4
+backoff_base = 1.0
+backoff_max = 60.0
+# status codes worth trying again
+retry_status = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def configure(conf):
+    # from config.yaml, has to be called before the first request to change the pool size
+    global max_per_host, timeout, pool_timeout, retries
+    max_per_host = conf.get("http_max_per_host", max_per_host)
+    timeout = tuple(conf.get("http_timeout", timeout))
+    pool_timeout = conf.get("http_pool_timeout", pool_timeout)
+    retries = conf.get("http_retries", retries)
+
+
+def _get_conn(pool, get_conn, timeout_):
+    # requests never passes a pool timeout, so a blocking pool would wait forever for a connection
+    return get_conn(pool, pool_timeout if timeout_ is None else timeout_)
+
+
+class _HTTPPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        return _get_conn(self, HTTPConnectionPool._get_conn, timeout)
+
+
+class _HTTPSPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        return _get_conn(self, HTTPSConnectionPool._get_conn, timeout)
+
+
+class _Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+
+def session():
+    # one keep-alive session for the whole process
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = _Adapter(pool_connections=16, pool_maxsize=max_per_host, pool_block=True)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def retry_delay(response, attempt):
+    # a 429 tells us how long to wait, either in seconds or as the epoch the limit resets
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.strip().isdigit():
+            return float(retry_after)
+        reset = response.headers.get("Ratelimit-Reset")
+        if reset is not None and reset.strip().isdigit():
+            return max(0.0, float(reset) - time.time()) + random.uniform(0.1, 1.0)
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+
+def _record(endpoint, latency, failed, retried):
+    with _stats_lock:
+        entry = _stats.setdefault(endpoint, {"requests": 0, "errors": 0, "retries": 0,
+                                             "total_time": 0.0, "max_time": 0.0})
+        entry["requests"] = entry["requests"] + 1
+        entry["errors"] = entry["errors"] + (1 if failed else 0)
+        entry["retries"] = entry["retries"] + (1 if retried else 0)
+        entry["total_time"] = entry["total_time"] + latency
+        entry["max_time"] = max(entry["max_time"], latency)
+
+
+def request(method, url, **kwargs):
+    """requests.request on the shared session, retrying connection errors, timeouts,
+    429s and 5xx with jittered backoff. The last response is returned (or the last
+    exception raised) once the retries are used up. Waiting longer than pool_timeout
+    for a free connection raises requests.ConnectionError.
+    """
+    kwargs.setdefault("timeout", timeout)
+    parts = urlsplit(url)
+    endpoint = parts.netloc + parts.path
+    attempt = 0
+    while True:
+        t0 = time.time()
+        response = None
+        error = None
+        try:
+            response = session().request(method, url, **kwargs)
+        except EmptyPoolError as e:
+            # every connection is held by someone else for a long time already, waiting more won't help
+            raise requests.ConnectionError("no free connection to " + parts.netloc + " after "
+                                           + str(pool_timeout) + " s") from e
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        failed = error is not None or response.status_code in retry_status
+        _record(endpoint, time.time() - t0, failed, attempt > 0)
+        if not failed or attempt >= retries:
+            if error is not None:
+                raise error
+            return response
+        delay = retry_delay(response, attempt)
+        if response is not None:
+            # a streamed response holds its connection until it is closed
+            response.close()
+        time.sleep(delay)
+        attempt = attempt + 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats():
+    with _stats_lock:
+        return dict((endpoint, dict(entry)) for endpoint, entry in _stats.items())
+
+
+def print_stats():
+    for endpoint, entry in sorted(stats().items()):
+        print("http " + endpoint + ": " + str(entry["requests"]) + " requests, "
+              + str(entry["retries"]) + " retries, " + str(entry["errors"]) + " errors, "
+              + "%.3f s avg, %.3f s max" % (entry["total_time"] / entry["requests"], entry["max_time"]))
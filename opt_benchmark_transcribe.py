@@ -0,0 +1,77 @@
+# !/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import difflib
+import tempfile
+import utils
+import transcribe
+
+# importing static-ffmpeg and pre-downloading
+import static_ffmpeg
+static_ffmpeg.add_paths()
+
+# compares the single stream transcription against the windowed parallel one on one video
+#   python3 opt_benchmark_transcribe.py <video.mp4> [workers] [window seconds] [overlap seconds]
+
+path_base = os.path.dirname(os.path.abspath(__file__))
+path_model = path_base + "/thirdparty/vosk-model-small-en-us-0.15/"
+ffmpeg_path = shutil.which('ffmpeg')
+
+if len(sys.argv) < 2:
+    print("usage: " + sys.argv[0] + " <video> [workers] [window] [overlap]")
+    exit(-1)
+file_path = sys.argv[1]
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+window = int(sys.argv[3]) if len(sys.argv) > 3 else 600
+overlap = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+duration = utils.get_media_duration(file_path)
+print("video: " + file_path + " (" + str(duration) + " seconds)")
+
+# load the model up front so neither run pays for it
+model_cache = transcribe.ModelCache(path_model)
+model_cache.get()
+
+
+def srt_words(path):
+    # every word of the captions in order, ignoring the index and timing lines
+    words = []
+    with open(path) as f:
+        for block in f.read().strip().split("\n\n"):
+            lines = block.split("\n")
+            if len(lines) >= 3:
+                words.extend(" ".join(lines[2:]).split())
+    return words
+
+
+path_out = tempfile.mkdtemp()
+file_single = os.path.join(path_out, "single.srt")
+file_parallel = os.path.join(path_out, "parallel.srt")
+
+t0 = time.time()
+transcribe.transcribe_srt(model_cache, ffmpeg_path, file_path, file_single)
+time_single = time.time() - t0
+print("single stream: " + str(time_single) + " seconds")
+
+t0 = time.time()
+transcribe.transcribe_srt_parallel(model_cache, ffmpeg_path, file_path, file_parallel, duration,
+                                   workers, window, overlap)
+time_parallel = time.time() - t0
+print("parallel (" + str(workers) + " workers, " + str(window) + "s windows): " + str(time_parallel) + " seconds")
+print("speedup: %.2fx" % (time_single / max(time_parallel, 0.001)))
+
+# how close the two transcripts are, seams that drop or double words show up here
+words_single = srt_words(file_single)
+words_parallel = srt_words(file_parallel)
+matcher = difflib.SequenceMatcher(None, words_single, words_parallel, autojunk=False)
+print("words: " + str(len(words_single)) + " single, " + str(len(words_parallel)) + " parallel")
+print("word match ratio: %.4f" % matcher.ratio())
+differences = [op for op in matcher.get_opcodes() if op[0] != "equal"]
+for tag, i1, i2, j1, j2 in differences[:20]:
+    print("\t" + tag + ": '" + " ".join(words_single[i1:i2]) + "' -> '" + " ".join(words_parallel[j1:j2]) + "'")
+if len(differences) > 20:
+    print("\t... " + str(len(differences) - 20) + " more differences")
+print("srt files kept in " + path_out)
@@ -0,0 +1,64 @@
+# !/usr/bin/env python3
+
+import yaml  # pip install PyYAML
+
+import os
+import sys
+import time
+import storage
+import archive_state
+
+# compresses the chat and info json files of an existing archive in place with the
+# compression set in config.yaml (or the one given), every file is replaced in one step
+# and files already in that format are skipped, so it can be stopped and run again
+#   python3 opt_compress_archive.py [gzip|zstd|none]
+
+path_base = os.path.dirname(os.path.abspath(__file__))
+with open(path_base + "/config/config.yaml") as f:
+    conf = yaml.load(f, Loader=yaml.FullLoader)
+if len(sys.argv) > 1:
+    conf["compression"] = sys.argv[1]
+storage.configure(conf)
+path_cache = path_base + conf.get("cache_dir", "/cache/")
+os.makedirs(path_cache, exist_ok=True)
+state = archive_state.ArchiveState(path_cache + "archive_state.db")
+
+# only the json artifacts, the media files are already compressed
+kinds = [("clip_info", "_clip_info.json"), ("clip_chat", "_clip_chat.json"), ("info", "_info.json"), ("chat", "_chat.json")]
+
+t0 = time.time()
+count_files = 0
+size_before = 0
+size_after = 0
+for config_name, root_key in [("videos.yaml", "video_downloads"), ("clips.yaml", "clip_downloads")]:
+    if not os.path.exists(path_base + "/config/" + config_name):
+        continue
+    with open(path_base + "/config/" + config_name) as f:
+        path_root = yaml.load(f, Loader=yaml.FullLoader)[root_key]
+    print("compressing json files in " + path_root + " (" + str(storage.compression) + ")")
+    for subdir, dirs, files in os.walk(path_root):
+        for file in files:
+            path = os.path.join(subdir, file)
+            # left behind by an interrupted run, the original next to it is still intact
+            if file.endswith(".json.tmp"):
+                os.remove(path)
+                continue
+            match = archive_state.re_filename.match(file)
+            kind = next((kind for kind, suffix in kinds if file.endswith(suffix)), None)
+            if match is None or kind is None or storage.sniff(path) == storage.compression:
+                continue
+            size = os.path.getsize(path)
+            storage.compress_file(path, storage.compression)
+            size_before = size_before + size
+            size_after = size_after + os.path.getsize(path)
+            count_files = count_files + 1
+            # keep the recorded size in step, without touching the state of the artifact
+            row = state.get(match.group(1), kind)
+            if row is not None and row["path"] == path:
+                state.record(match.group(1), kind, path, state=row["state"], detail=row["detail"])
+            if count_files % 100 == 0:
+                print("\t- " + str(count_files) + " files, " + str(size_before // (1024 * 1024)) + " MB -> "
+                      + str(size_after // (1024 * 1024)) + " MB")
+state.close()
+print("rewrote " + str(count_files) + " files, " + str(size_before // (1024 * 1024)) + " MB -> "
+      + str(size_after // (1024 * 1024)) + " MB in " + str(time.time() - t0) + " seconds")
@@ -9,7 +9,7 @@ import subprocess
 import utils
 import datetime
 import shutil
-from vosk import Model, KaldiRecognizer, SetLogLevel  # pip install vosk
+import transcribe
 
 
 # authentication information
@@ -33,6 +33,9 @@ path_twitch_ffmpeg = path_base + "/thirdparty/ffmpeg-4.3.1-amd64-static/ffmpeg"
 path_root = path_base + "/../data/"
 path_model = path_base + "/thirdparty/vosk-model-small-en-us-0.15/"
 
+# loaded once on the first video and reused for the rest
+model_cache = transcribe.ModelCache(path_model)
+
 # ================================================================
 # ================================================================
 
@@ -77,12 +80,9 @@ for ct in range(len(files_names)):
     if not utils.terminated_requested and os.path.exists(files_names[ct]) and not os.path.exists(file_path_webvtt):
         t0 = time.time()
 
-        # open the model
-        SetLogLevel(-1)
-        sample_rate = 16000
-        model = Model(path_model)
-        rec = KaldiRecognizer(model, sample_rate)
-        rec.SetWords(True)
+        # new recognizer on the shared model
+        sample_rate = transcribe.sample_rate
+        rec = model_cache.recognizer()
 
         # open ffmpeg pipe stream of the audio file (from video)
         command = [path_twitch_ffmpeg, '-nostdin', '-loglevel', 'quiet', '-i', files_names[ct],
@@ -0,0 +1,106 @@
+# Import general libraries
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+# states a stage of a job can be in
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Job(object):
+    """One video worth of work, split into stages that depend on each other.
+
+    Stages are added with add(name, fn, deps). fn(job) is run on the pool of
+    that stage and returns True once its artifact is available. A stage only
+    starts once all of its deps are DONE, and is SKIPPED if any of them is not.
+    Anything the stages need to share (paths, api data) goes into job.data.
+    """
+
+    def __init__(self, name, log, data=None):
+        self.name = name
+        self.log = log
+        self.data = data if data is not None else {}
+        self.stages = []
+        self.funcs = {}
+        self.deps = {}
+        self.state = {}
+        # artifacts produced by finished stages (e.g. "video" -> mp4 path)
+        self.artifacts = {}
+        self.finished = threading.Event()
+
+    def add(self, name, fn, deps=()):
+        self.stages.append(name)
+        self.funcs[name] = fn
+        self.deps[name] = list(deps)
+        self.state[name] = PENDING
+
+    def wait(self):
+        self.finished.wait()
+
+    def ok(self):
+        return all(self.state[name] == DONE for name in self.stages)
+
+
+class Pipeline(object):
+    """Runs jobs with one worker pool per stage so different stages overlap.
+
+    While one video is transcribed the next can already be downloading, and
+    each stage is limited by its own number of workers.
+    """
+
+    def __init__(self, limits):
+        self.lock = threading.Lock()
+        self.pools = {}
+        for name, workers in limits.items():
+            self.pools[name] = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def submit(self, job):
+        with self.lock:
+            ready = [name for name in job.stages if len(job.deps[name]) == 0]
+            for name in ready:
+                job.state[name] = RUNNING
+        if len(ready) == 0:
+            job.finished.set()
+        for name in ready:
+            self.pools[name].submit(self._run, job, name)
+        return job
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+
+    def _run(self, job, name):
+        result = False
+        if not utils.terminated_requested:
+            try:
+                result = job.funcs[name](job)
+            except Exception as e:
+                job.log("ERR: " + name + " failed for " + job.name + ": " + str(e))
+        self._finish(job, name, DONE if result else FAILED)
+
+    def _finish(self, job, name, state):
+        ready = []
+        with self.lock:
+            job.state[name] = state
+            changed = True
+            while changed:
+                changed = False
+                for other in job.stages:
+                    if job.state[other] != PENDING:
+                        continue
+                    dep_states = [job.state[dep] for dep in job.deps[other]]
+                    if any(s in (FAILED, SKIPPED) for s in dep_states):
+                        job.state[other] = SKIPPED
+                        changed = True
+                    elif all(s == DONE for s in dep_states):
+                        job.state[other] = RUNNING
+                        ready.append(other)
+            if all(s not in (PENDING, RUNNING) for s in job.state.values()):
+                job.finished.set()
+        for other in ready:
+            self.pools[other].submit(self._run, job, other)
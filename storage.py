@@ -0,0 +1,97 @@
+# Import general libraries
+import io
+import os
+import json
+import gzip
+import shutil
+
+try:
+    import zstandard  # pip install zstandard (only needed for compression: zstd)
+except ImportError:
+    zstandard = None
+
+# how chat and info json files are written: None, "gzip" or "zstd"
+# files keep their names, readers tell the formats apart by their first bytes
+compression = None
+
+gzip_magic = b"\x1f\x8b"
+zstd_magic = b"\x28\xb5\x2f\xfd"
+
+
+def configure(conf):
+    global compression
+    compression = conf.get("compression", None)
+    if compression in ("none", "None", False):
+        compression = None
+    if compression not in (None, "gzip", "zstd"):
+        raise ValueError("unknown compression: " + str(compression))
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("compression: zstd needs the zstandard package")
+
+
+def sniff(path):
+    # "gzip", "zstd" or None for a plain file
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(gzip_magic):
+        return "gzip"
+    if magic == zstd_magic:
+        return "zstd"
+    return None
+
+
+def open_read(path):
+    # text stream of a json file, however it is stored
+    kind = sniff(path)
+    if kind == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if kind == "zstd":
+        if zstandard is None:
+            raise ValueError(path + " is zstd compressed, that needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def open_write(path, kind=None):
+    # text stream writing path in the given compression (None writes a plain file)
+    if kind == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    if kind == "zstd":
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb")), encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def load_json(path):
+    with open_read(path) as f:
+        return json.load(f)
+
+
+def write_json(path, data, indent=4):
+    # info files, in the configured compression and replaced in one step
+    with open_write(path + ".tmp", compression) as f:
+        json.dump(data, f, indent=indent)
+    os.replace(path + ".tmp", path)
+
+
+def compress_file(path, kind):
+    # (re)write a file in place in the given compression, a crash leaves the original untouched
+    with open_read(path) as src, open_write(path + ".tmp", kind) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(path + ".tmp", path)
+
+
+def publish(path_tmp, path):
+    # move a freshly downloaded json into the archive, compressing it on the way if configured
+    if compression is None or sniff(path_tmp) == compression:
+        shutil.move(path_tmp, path)
+        return
+    with open_read(path_tmp) as src, open_write(path + ".tmp", compression) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(path + ".tmp", path)
+    os.remove(path_tmp)
+
+
+def plain_copy(path, path_out):
+    # for tools that only read plain json (chatrender)
+    with open_read(path) as src, open(path_out, "w", encoding="utf-8") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
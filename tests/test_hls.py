@@ -0,0 +1,276 @@
+# Tests for hls.py against a local http server, run with "python -m pytest tests"
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hls  # noqa: E402
+
+master_playlist = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=1400000,RESOLUTION=1280x720
+720p30/index-dvr.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080
+chunked/index-dvr.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=160000
+audio_only/index-dvr.m3u8
+"""
+
+# stands in for ffmpeg in the tests that don't need a real one: joins by concatenating
+fake_ffmpeg = """import sys
+import shutil
+args = sys.argv[1:]
+if "pipe:0" in args:
+    shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)
+else:
+    shutil.copyfile(args[args.index("-i") + 1], args[-1])
+"""
+
+
+def media_text(names, durations=None, init=None):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:10"]
+    if init is not None:
+        lines.append('#EXT-X-MAP:URI="' + init + '"')
+    for i, name in enumerate(names):
+        lines.append("#EXTINF:" + str(durations[i] if durations else 10.0) + ",")
+        lines.append(name)
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class Server(object):
+    """Serves files from a dict, path -> bytes. Paths in fail_once answer 404 the first time."""
+
+    def __init__(self):
+        self.files = {}
+        self.fail_once = set()
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                server.requests.append(path)
+                if path in server.fail_once:
+                    server.fail_once.discard(path)
+                    self.send_error(404)
+                    return
+                if path not in server.files:
+                    self.send_error(403)
+                    return
+                body = server.files[path]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class HlsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        self.temp = tempfile.mkdtemp()
+        self.log = []
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def write_fake_ffmpeg(self):
+        path = os.path.join(self.temp, "ffmpeg")
+        with open(path, "w") as f:
+            f.write("#!" + sys.executable + "\n" + fake_ffmpeg)
+        os.chmod(path, 0o755)
+        return path
+
+    def download(self, ffmpeg_path, out, batch=100):
+        return hls.download(self.server.url + "/master.m3u8", out, os.path.join(self.temp, "work") + "/",
+                            ffmpeg_path, workers=2, per_host=0, batch=batch, log=self.log.append)
+
+
+class TestPlaylist(HlsTestCase):
+
+    def test_parse_master(self):
+        variants, init, segments = hls.parse_playlist(master_playlist, "https://host/vod/master.m3u8")
+        self.assertEqual(variants, [(1400000, "https://host/vod/720p30/index-dvr.m3u8"),
+                                    (6000000, "https://host/vod/chunked/index-dvr.m3u8"),
+                                    (160000, "https://host/vod/audio_only/index-dvr.m3u8")])
+        self.assertIsNone(init)
+        self.assertEqual(segments, [])
+
+    def test_parse_media(self):
+        text = media_text(["0.mp4", "1-unmuted.mp4"], [10.0, 4.5], init="init-0.mp4")
+        variants, init, segments = hls.parse_playlist(text, "https://host/vod/chunked/index-dvr.m3u8")
+        self.assertEqual(variants, [])
+        self.assertEqual(init, "https://host/vod/chunked/init-0.mp4")
+        self.assertEqual(segments, [("https://host/vod/chunked/0.mp4", 10.0),
+                                    ("https://host/vod/chunked/1-unmuted.mp4", 4.5)])
+
+    def test_media_playlist_picks_source(self):
+        self.server.files["/master.m3u8"] = master_playlist.encode()
+        self.server.files["/720p30/index-dvr.m3u8"] = media_text(["0.ts"]).encode()
+        self.server.files["/chunked/index-dvr.m3u8"] = media_text(["0.ts", "1.ts"]).encode()
+        self.server.files["/audio_only/index-dvr.m3u8"] = media_text(["0.ts"]).encode()
+        init, segments = hls.media_playlist(self.server.url + "/master.m3u8")
+        self.assertIsNone(init)
+        self.assertEqual([url for url, duration in segments],
+                         [self.server.url + "/chunked/0.ts", self.server.url + "/chunked/1.ts"])
+
+
+class TestFetch(HlsTestCase):
+
+    def test_unmuted_falls_back_to_muted(self):
+        self.server.files["/chunked/3-muted.ts"] = b"muted"
+        path = os.path.join(self.temp, "seg3.ts")
+        hls.fetch(self.server.url + "/chunked/3-unmuted.ts", path, hls.HostLimiter(0))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"muted")
+        self.assertEqual(self.server.requests, ["/chunked/3-unmuted.ts", "/chunked/3-muted.ts"])
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_existing_segment_is_not_fetched(self):
+        path = os.path.join(self.temp, "seg0.ts")
+        with open(path, "wb") as f:
+            f.write(b"have")
+        hls.fetch(self.server.url + "/chunked/0.ts", path, hls.HostLimiter(0))
+        self.assertEqual(self.server.requests, [])
+
+
+class TestDownload(HlsTestCase):
+
+    def serve_vod(self, count):
+        names = [str(i) + ".ts" for i in range(count)]
+        self.server.files["/master.m3u8"] = master_playlist.replace("chunked/", "source/").encode()
+        self.server.files["/source/index-dvr.m3u8"] = media_text(names).encode()
+        for i, name in enumerate(names):
+            self.server.files["/source/" + name] = ("segment " + str(i) + ";").encode()
+        return b"".join(self.server.files["/source/" + name] for name in names)
+
+    def test_resume_after_failed_segment(self):
+        expected = self.serve_vod(7)
+        self.server.fail_once.add("/source/3.ts")
+        ffmpeg_path = self.write_fake_ffmpeg()
+        out = os.path.join(self.temp, "out.mp4")
+        work = os.path.join(self.temp, "work")
+
+        self.assertFalse(self.download(ffmpeg_path, out, batch=2))
+        self.assertFalse(os.path.exists(out))
+        with open(os.path.join(work, "joined.json")) as f:
+            progress = json.load(f)
+        self.assertEqual(progress["parts"], 3)
+        with open(os.path.join(work, "joined.ts"), "rb") as f:
+            self.assertEqual(f.read(), expected[:progress["size"]])
+        # the joined segments are gone, the rest is left for the next run
+        for i in range(3):
+            self.assertFalse(os.path.exists(os.path.join(work, "seg0000" + str(i) + ".ts")))
+
+        self.server.requests = []
+        self.assertTrue(self.download(ffmpeg_path, out, batch=2))
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), expected)
+        self.assertNotIn("/source/0.ts", self.server.requests)
+        self.assertIn("/source/3.ts", self.server.requests)
+        self.assertEqual(os.listdir(work), [])
+
+    def test_init_section_starts_every_batch(self):
+        self.serve_vod(5)
+        self.server.files["/source/index-dvr.m3u8"] = media_text(
+            [str(i) + ".ts" for i in range(5)], init="init-0.mp4").encode()
+        self.server.files["/source/init-0.mp4"] = b"init;"
+        out = os.path.join(self.temp, "out.mp4")
+        self.assertTrue(self.download(self.write_fake_ffmpeg(), out, batch=2))
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), b"init;segment 0;segment 1;init;segment 2;segment 3;init;segment 4;")
+        self.assertEqual(os.listdir(os.path.join(self.temp, "work")), [])
+
+    def test_bytes_past_checkpoint_are_dropped(self):
+        expected = self.serve_vod(4)
+        ffmpeg_path = self.write_fake_ffmpeg()
+        work = os.path.join(self.temp, "work")
+        os.makedirs(work)
+        # a run that died after writing part of a batch but before its checkpoint
+        with open(os.path.join(work, "joined.ts"), "wb") as f:
+            f.write(expected[:20] + b"garbage")
+        with open(os.path.join(work, "joined.json"), "w") as f:
+            json.dump({"parts": 2, "size": 20}, f)
+        out = os.path.join(self.temp, "out.mp4")
+        self.assertTrue(self.download(ffmpeg_path, out))
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), expected)
+
+
+class TestFfmpegJoin(HlsTestCase):
+    """The join with the real ffmpeg, on segments it cut itself."""
+
+    def setUp(self):
+        self.ffmpeg_path = shutil.which("ffmpeg")
+        if self.ffmpeg_path is None:
+            self.skipTest("ffmpeg isn't installed")
+        HlsTestCase.setUp(self)
+
+    def ffmpeg(self, *args):
+        return subprocess.run([self.ffmpeg_path, "-nostdin", "-hide_banner", "-y"] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def duration(self, path):
+        proc = self.ffmpeg("-i", path, "-map", "0", "-c", "copy", "-f", "null", "-")
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode(errors="replace"))
+        match = re.search(r"Duration: (\d+):(\d+):([\d.]+)", proc.stderr.decode(errors="replace"))
+        return int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
+    def serve_encoded(self, segment_type):
+        source = os.path.join(self.temp, "source")
+        os.makedirs(source)
+        proc = self.ffmpeg("-f", "lavfi", "-i", "testsrc=duration=6:size=160x120:rate=10",
+                           "-f", "lavfi", "-i", "sine=duration=6",
+                           "-c:v", "libx264", "-g", "10", "-c:a", "aac", "-f", "hls", "-hls_time", "1",
+                           "-hls_segment_type", segment_type, "-hls_playlist_type", "vod",
+                           os.path.join(source, "index-dvr.m3u8"))
+        if proc.returncode != 0:
+            self.skipTest("ffmpeg can't encode the test vod: " + proc.stderr.decode(errors="replace")[-200:])
+        for name in os.listdir(source):
+            with open(os.path.join(source, name), "rb") as f:
+                self.server.files["/source/" + name] = f.read()
+        self.server.files["/master.m3u8"] = master_playlist.replace("chunked/", "source/").encode()
+        for name in ("720p30", "audio_only"):
+            self.server.files["/" + name + "/index-dvr.m3u8"] = media_text(["0.ts"]).encode()
+
+    def check_join(self, segment_type):
+        self.serve_encoded(segment_type)
+        # the joined file is mpegts, which the final remux has to be able to read
+        probe = os.path.join(self.temp, "probe.ts")
+        self.ffmpeg("-f", "lavfi", "-i", "testsrc=duration=1", "-c:v", "libx264", probe)
+        if self.ffmpeg("-i", probe, "-f", "null", "-").returncode != 0:
+            self.skipTest("this ffmpeg can't read mpegts")
+        out = os.path.join(self.temp, "out.mp4")
+        self.assertTrue(self.download(self.ffmpeg_path, out, batch=2), self.log)
+        self.assertAlmostEqual(self.duration(out), 6.0, delta=0.5)
+        self.assertEqual(os.listdir(os.path.join(self.temp, "work")), [])
+
+    def test_join_mpegts(self):
+        self.check_join("mpegts")
+
+    def test_join_fmp4(self):
+        self.check_join("fmp4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+# Import general libraries
+import os
+import json
+import time
+import resource
+import threading
+import subprocess
+import utils
+from concurrent.futures import ThreadPoolExecutor
+from vosk import Model, KaldiRecognizer, SetLogLevel  # pip install vosk
+
+# vosk wants 16khz mono audio
+sample_rate = 16000
+words_per_line = 7
+log = utils.channel_logger("vosk")
+
+
+def resident_memory_mb():
+    # current resident set size of this process, falls back to the peak if /proc isn't there
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class ModelCache(object):
+    """Loads the vosk model the first time a transcription needs it and shares it
+    with every transcription after that. Each job still gets its own recognizer.
+    """
+
+    def __init__(self, path_model):
+        self.path_model = path_model
+        self.model = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.model is None:
+                SetLogLevel(-1)
+                t0 = time.time()
+                mem0 = resident_memory_mb()
+                self.model = Model(self.path_model)
+                mem1 = resident_memory_mb()
+                log("loaded model " + os.path.basename(os.path.normpath(self.path_model))
+                    + " in " + str(time.time() - t0) + " seconds (%.0f MB resident, +%.0f MB)" % (mem1, mem1 - mem0))
+            return self.model
+
+    def recognizer(self):
+        rec = KaldiRecognizer(self.get(), sample_rate)
+        rec.SetWords(True)
+        return rec
+
+    def release(self):
+        with self.lock:
+            if self.model is not None:
+                self.model = None
+                log("released model (%.0f MB resident)" % resident_memory_mb())
+
+
+def transcribe_srt(model_cache, ffmpeg_path, file_path, file_path_srt):
+    # pipe the audio of the video through ffmpeg straight into the recognizer
+    rec = model_cache.recognizer()
+    with subprocess.Popen([ffmpeg_path, "-loglevel", "quiet", "-i",
+                           file_path,
+                           "-ar", str(sample_rate), "-ac", "1", "-f", "s16le", "-"],
+                          stdout=subprocess.PIPE).stdout as stream:
+        srt = rec.SrtResult(stream)
+    # a ctrl+c also kills ffmpeg, don't keep the cut off transcript
+    if utils.terminated_requested:
+        return False
+    with open(file_path_srt, 'w') as f:
+        f.write(srt)
+    return True
+
+
+def _recognize_window(model_cache, ffmpeg_path, file_path, start, end, overlap):
+    # recognize [start - overlap, end + overlap] of the audio but only keep the words
+    # whose middle falls inside [start, end), the neighbouring windows own the rest
+    read_start = max(0.0, start - overlap)
+    command = [ffmpeg_path, "-nostdin", "-loglevel", "quiet", "-ss", str(read_start), "-i", file_path]
+    if end is not None:
+        command += ["-t", str(end + overlap - read_start)]
+    command += ["-ar", str(sample_rate), "-ac", "1", "-f", "s16le", "-"]
+
+    rec = model_cache.recognizer()
+    results = []
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    while True:
+        data = process.stdout.read(4000)
+        if len(data) == 0:
+            break
+        if rec.AcceptWaveform(data):
+            results.append(rec.Result())
+    results.append(rec.FinalResult())
+    process.wait()
+
+    lines = []
+    for res in results:
+        words = []
+        for word in json.loads(res).get("result", []):
+            word["start"] = word["start"] + read_start
+            word["end"] = word["end"] + read_start
+            middle = (word["start"] + word["end"]) / 2.0
+            if middle >= start and (end is None or middle < end):
+                words.append(word)
+        if len(words) > 0:
+            lines.append(words)
+    return lines
+
+
+def words_to_srt(results):
+    # same layout as KaldiRecognizer.SrtResult, a caption per words_per_line words of an utterance
+    captions = []
+    for words in results:
+        for j in range(0, len(words), words_per_line):
+            line = words[j:j + words_per_line]
+            captions.append(str(len(captions) + 1) + "\n"
+                            + utils.srt_time_string(line[0]["start"]) + " --> "
+                            + utils.srt_time_string(line[-1]["end"]) + "\n"
+                            + " ".join([w["word"] for w in line]) + "\n\n")
+    return "".join(captions)
+
+
+def transcribe_srt_parallel(model_cache, ffmpeg_path, file_path, file_path_srt, duration,
+                            workers, window=600, overlap=5):
+    # split the audio into windows and recognize them at the same time
+    # vosk drops the GIL while decoding, so threads sharing one model use all the cores
+    if duration <= 0 or workers <= 1 or duration <= window:
+        return transcribe_srt(model_cache, ffmpeg_path, file_path, file_path_srt)
+    starts = list(range(0, int(duration), int(window)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i, start in enumerate(starts):
+            # the last window runs to the end of the file in case the real length is longer
+            end = starts[i + 1] if i + 1 < len(starts) else None
+            futures.append(executor.submit(_recognize_window, model_cache, ffmpeg_path,
+                                           file_path, start, end, overlap))
+        results = []
+        for future in futures:
+            results.extend(future.result())
+    if utils.terminated_requested:
+        return False
+    with open(file_path_srt, 'w') as f:
+        f.write(words_to_srt(results))
+    return True
@@ -4,11 +4,24 @@ import sys
 import json
 import signal
 import string
-import requests
+import shutil
+import threading
+import subprocess
+import http_client
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl  # only on unix, elsewhere overlapping runs aren't kept apart
+except ImportError:
+    fcntl = None
 
 # global variable which sets if we should terminate
 terminated_requested = False
 
+# endpoints, module level so they can be pointed at a local server
+gql_url = 'https://gql.twitch.tv/gql'
+pushover_url = 'https://api.pushover.net/1/messages.json'
+
 
 def signal_handler(sig, frame):
     global terminated_requested
@@ -19,6 +32,18 @@ def signal_handler(sig, frame):
 def setup_signal_handle():
     signal.signal(signal.SIGINT, signal_handler)
 
+# only one thread may print at a time so lines from parallel channels stay whole
+print_lock = threading.Lock()
+
+
+def channel_logger(name):
+    prefix = "[" + name + "] "
+
+    def log(text):
+        with print_lock:
+            print(prefix + text, flush=True)
+    return log
+
 def webvtt_time_string(seconds):
     minutes = seconds / 60
     seconds = seconds % 60
@@ -26,36 +51,246 @@ def webvtt_time_string(seconds):
     minutes = int(minutes % 60)
     return '%i:%02i:%06.3f' % (hours, minutes, seconds)
 
+def srt_time_string(seconds):
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    seconds, millis = divmod(millis, 1000)
+    return '%02i:%02i:%02i,%03i' % (hours, minutes, seconds, millis)
+
+def duration_to_seconds(duration):
+    # helix durations look like "3h8m33s"
+    seconds = 0
+    number = ''
+    for c in str(duration):
+        if c.isdigit():
+            number += c
+        elif c in 'hms' and number != '':
+            seconds += int(number) * {'h': 3600, 'm': 60, 's': 1}[c]
+            number = ''
+    return seconds
+
+def get_media_duration(file_path, ffprobe_path=None):
+    # length of a media file in seconds according to ffprobe, -1 if it can't be read
+    if ffprobe_path is None:
+        ffprobe_path = shutil.which('ffprobe')
+    if ffprobe_path is None:
+        return -1
+    proc = subprocess.run([ffprobe_path, '-v', 'error', '-show_entries', 'format=duration',
+                           '-of', 'default=noprint_wrappers=1:nokey=1', file_path],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return float(proc.stdout.decode().strip())
+    except ValueError:
+        return -1
+
+def count_video_frames(file_path, ffprobe_path=None):
+    # number of frames in the first video stream, counted from the packets, -1 if it can't be read
+    if ffprobe_path is None:
+        ffprobe_path = shutil.which('ffprobe')
+    if ffprobe_path is None:
+        return -1
+    proc = subprocess.run([ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+                           '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', file_path],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return int(proc.stdout.decode().strip())
+    except ValueError:
+        return -1
+
+def keyframe_before(file_path, seconds, ffprobe_path=None, search=30):
+    # time of the last video keyframe at or before seconds, a stream copy can only start on one
+    # only the search seconds before it are read, falls back to seconds itself if none is found
+    if ffprobe_path is None:
+        ffprobe_path = shutil.which('ffprobe')
+    if ffprobe_path is None:
+        return seconds
+    start = max(0, seconds - search)
+    proc = subprocess.run([ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+                           '-read_intervals', str(start) + '%' + str(seconds + 0.001),
+                           '-show_entries', 'frame=pts_time', '-of', 'csv=p=0', file_path],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    keyframe = None
+    for line in proc.stdout.decode().split():
+        try:
+            t = float(line.strip().strip(','))
+        except ValueError:
+            continue
+        if t <= seconds and (keyframe is None or t > keyframe):
+            keyframe = t
+    return keyframe if keyframe is not None else seconds
+
+def write_json_atomic(path, data, indent=4):
+    # write next to the target and swap it in, so a crash never leaves half a file behind
+    path_tmp = path + ".tmp"
+    with open(path_tmp, 'w', encoding="utf-8") as file:
+        json.dump(data, file, indent=indent)
+    os.replace(path_tmp, path)
+
+class JsonStore(object):
+    """A small dict that lives in a json file, shared with any other run using the same file.
+
+    Reads reload the file once another process has saved it. Every change
+    re-reads the file under a lock file and only applies itself on top, so
+    runs that overlap don't overwrite each other's entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        self.stamp = None
+        with self.lock:
+            self._reload()
+
+    def _reload(self, force=False):
+        # lock held, only read the file again if it changed since we last did
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if force or (stat.st_mtime_ns, stat.st_size) != self.stamp:
+            with open(self.path, encoding="utf-8") as f:
+                self.data = json.load(f)
+            self.stamp = (stat.st_mtime_ns, stat.st_size)
+
+    def _change(self, fn):
+        with self.lock, file_lock(self.path + ".lock"):
+            # the stamp can miss a save within the same clock tick, under the file lock read it for sure
+            self._reload(force=True)
+            # fn returns False when it didn't change anything
+            if fn(self.data) is not False:
+                self.save()
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._reload()
+            return self.data.get(str(key), default)
+
+    def set(self, key, value):
+        self._change(lambda data: data.__setitem__(str(key), value))
+
+    def update(self, values):
+        self._change(lambda data: data.update((str(key), value) for key, value in values.items()))
+
+    def delete(self, key):
+        self._change(lambda data: data.pop(str(key), None) is not None)
+
+    def modify(self, key, fn):
+        """Replace the value of key with fn(current value or None), as one step. Returns the new value."""
+        result = []
+
+        def change(data):
+            result.append(fn(data.get(str(key))))
+            data[str(key)] = result[0]
+        self._change(change)
+        return result[0]
+
+    def save(self):
+        write_json_atomic(self.path, self.data, indent=None)
+        stat = os.stat(self.path)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+
+
+class file_lock(object):
+    """Exclusive lock on a lock file between processes, a no-op where fcntl isn't available."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.file = open(self.path, "a")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
 def get_valid_filename(filename):
     valid_chars = "-_%s%s" % (string.ascii_letters, string.digits)
     filename = filename.lower().replace(' ', '_')
     return ''.join(c for c in filename if c in valid_chars)
 
+def parse_vod_moments(gql_video):
+    moments = []
+    for moment in gql_video["moments"]["edges"]:
+        data = {
+            "duration": int(moment["node"]["durationMilliseconds"] / 1000.0),
+            "offset": int(moment["node"]["positionMilliseconds"] / 1000.0),
+        }
+        if "details" in moment["node"] and "game" in moment["node"]["details"]:
+            data["id"] = moment["node"]["details"]["game"]["id"]
+            data["name"] = moment["node"]["details"]["game"]["displayName"]
+        else:
+            data["id"] = "-1"
+            data["name"] = "Unknown"
+        if "type" in moment["node"]:
+            data["type"] = moment["node"]["type"]
+        moments.append(data)
+    return moments
+
 def get_vod_moments(void_id):
     # get response
     try:
         gql_response = get_vod_graphql_info(void_id)
         gql_obj = json.loads(gql_response)
-        moments = []
-        for moment in gql_obj["data"]["video"]["moments"]["edges"]:
-            data = {
-                "duration": int(moment["node"]["durationMilliseconds"] / 1000.0),
-                "offset": int(moment["node"]["positionMilliseconds"] / 1000.0),
-            }
-            if "details" in moment["node"] and "game" in moment["node"]["details"]:
-                data["id"] = moment["node"]["details"]["game"]["id"]
-                data["name"] = moment["node"]["details"]["game"]["displayName"]
-            else:
-                data["id"] = "-1"
-                data["name"] = "Unknown"
-            if "type" in moment["node"]:
-                data["type"] = moment["node"]["type"]
-            moments.append(data)
-        return moments
+        return parse_vod_moments(gql_obj["data"]["video"])
     except Exception as e:
         print(e)
         return []
 
+def get_vod_moments_batch(vod_ids, batch_size=20):
+    # one graphql request per batch_size vods, each vod is an aliased video(id:) field
+    # vods whose lookup failed are left out of the result
+    results = {}
+    vod_ids = [str(vod_id) for vod_id in vod_ids]
+    for i in range(0, len(vod_ids), batch_size):
+        batch = vod_ids[i:i + batch_size]
+        try:
+            gql_obj = json.loads(get_vod_graphql_info_batch(batch))
+            for j, vod_id in enumerate(batch):
+                video = gql_obj["data"].get("v" + str(j))
+                if video is not None and video.get("moments") is not None:
+                    results[vod_id] = parse_vod_moments(video)
+        except Exception as e:
+            print(e)
+    return results
+
+class VodMoments(object):
+    """Moments of vods, looked up in batches and remembered for the run.
+
+    Nothing is kept between runs, once the info of a vod has its moments it
+    isn't asked for them again and a vod that had none is asked again next run.
+    """
+
+    def __init__(self):
+        self.memo = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, vod_ids):
+        with self.lock:
+            missing = [str(v) for v in vod_ids if str(v) not in self.memo]
+        if len(missing) == 0:
+            return
+        found = get_vod_moments_batch(missing)
+        with self.lock:
+            for vod_id in missing:
+                self.memo[vod_id] = found.get(vod_id, [])
+
+    def get(self, vod_id):
+        with self.lock:
+            if str(vod_id) in self.memo:
+                return self.memo[str(vod_id)]
+        self.prefetch([vod_id])
+        with self.lock:
+            return self.memo[str(vod_id)]
+
 def get_vod_moments_from_twitcharchive_string(data):
     # get response
     try:
@@ -81,18 +316,8 @@ def get_vod_moments_from_twitcharchive_string(data):
         return []
 
 
-def get_vod_graphql_info(vod_id):
-    # seems to just be a default client id
-    # https://dev.twitch.tv/docs/authentication
-    client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
-    # auth = "xxxxxx"
-
-    # formulate the graphql query format
-    # https://graphiql-online.com/graphiql
-    # https://api.twitch.tv/gql
-    query = '''
-    query Query($videoId: ID) {
-        video(id: $videoId) {
+# the moments of a video, asked for by the single and the batched query
+vod_moments_fields = '''
           moments(momentRequestType: VIDEO_CHAPTER_MARKERS, types: GAME_CHANGE) {
             pageInfo {
               hasNextPage
@@ -114,20 +339,48 @@ def get_vod_graphql_info(vod_id):
               }
             }
           }
-        }
-      }
-    '''
+'''
+
+
+def get_vod_graphql_info(vod_id):
+    # seems to just be a default client id
+    # https://dev.twitch.tv/docs/authentication
+    client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+    # auth = "xxxxxx"
+
+    # formulate the graphql query format
+    # https://graphiql-online.com/graphiql
+    # https://api.twitch.tv/gql
+    query = 'query Query($videoId: ID) {\n video(id: $videoId) {' + vod_moments_fields + '}\n}'
     variables = {'videoId': vod_id}
-    url = 'https://gql.twitch.tv/gql'
-    response = requests.post(
-        url,
+    response = http_client.post(
+        gql_url,
         json={'query': query, 'variables': variables},
         # headers={"Client-ID": client_id, "Authorization": "OAuth "+auth}
         headers={"Client-ID": client_id}
     )
+    response.raise_for_status()
     return response.text
 
 
+def get_vod_graphql_info_batch(vod_ids):
+    # seems to just be a default client id
+    # https://dev.twitch.tv/docs/authentication
+    client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+
+    # one aliased video field per vod, v0 is vod_ids[0] and so on
+    fields = []
+    for i, vod_id in enumerate(vod_ids):
+        fields.append('v' + str(i) + ': video(id: ' + json.dumps(str(vod_id)) + ') {' + vod_moments_fields + '}')
+    query = 'query {\n' + '\n'.join(fields) + '\n}'
+    response = http_client.post(
+        gql_url,
+        json={'query': query},
+        headers={"Client-ID": client_id}
+    )
+    response.raise_for_status()
+    return response.text
+
 def get_clip_data(clip_id):
     # get response
     try:
@@ -168,45 +421,72 @@ def get_clip_graphql_info(clip_id):
       }
     '''
     variables = {'clip_id': clip_id}
-    url = 'https://gql.twitch.tv/gql'
-    response = requests.post(
-        url,
+    response = http_client.post(
+        gql_url,
         json={'query': query, 'variables': variables},
         # headers={"Client-ID": client_id, "Authorization": "OAuth "+auth}
         headers={"Client-ID": client_id}
     )
+    response.raise_for_status()
+    return response.text
+
+def get_clip_data_batch(clip_ids, batch_size=25, workers=4):
+    # resolve where many clips are in their vods, batch_size aliased clip(slug:) fields
+    # per graphql request and up to workers requests at once. Clips that failed,
+    # alone or with their whole request, get the same -1 sentinels as get_clip_data
+    clip_ids = [str(clip_id) for clip_id in clip_ids]
+    results = dict((clip_id, {"vod_id": -1, "offset": -1, "duration": -1}) for clip_id in clip_ids)
+
+    def resolve(batch):
+        try:
+            gql_obj = json.loads(get_clip_graphql_info_batch(batch))
+            for j, clip_id in enumerate(batch):
+                clip = gql_obj["data"].get("c" + str(j))
+                if clip is None or clip.get("video") is None or clip.get("videoOffsetSeconds") is None:
+                    continue
+                results[clip_id] = {
+                    "vod_id": clip["video"]["id"],
+                    "offset": clip["videoOffsetSeconds"],
+                    "duration": clip["durationSeconds"],
+                }
+        except Exception as e:
+            print(e)
+
+    batches = [clip_ids[i:i + batch_size] for i in range(0, len(clip_ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(resolve, batches))
+    return results
+
+def get_clip_graphql_info_batch(clip_ids):
+    # seems to just be a default client id
+    # https://dev.twitch.tv/docs/authentication
+    client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+
+    # one aliased clip field per slug, c0 is clip_ids[0] and so on
+    fields = []
+    for i, clip_id in enumerate(clip_ids):
+        fields.append('c' + str(i) + ': clip(slug: ' + json.dumps(str(clip_id)) + ') {'
+                      + ' videoOffsetSeconds viewCount durationSeconds video { id } }')
+    query = 'query {\n' + '\n'.join(fields) + '\n}'
+    response = http_client.post(
+        gql_url,
+        json={'query': query},
+        headers={"Client-ID": client_id}
+    )
+    response.raise_for_status()
     return response.text
 
 def send_pushover_message(auth, text):
     if auth["pushover_enable"]:
         payload = {"message": text, "user": auth["pushover_user_key"], "token": auth["pushover_app_key"] }
-        resp = requests.post('https://api.pushover.net/1/messages.json', data=payload, headers={'User-Agent': 'Python'})
+        try:
+            resp = http_client.post(pushover_url, data=payload, headers={'User-Agent': 'Python'})
+        except Exception as e:
+            print("[error]: could not reach pushover: " + str(e))
+            return
         if not resp.ok:
             print("[error]: bad response from pushover: ")
             print(resp)
 
 def cleanFilename(sourcestring,  removestring ="\!\"\#\$\&\'\(\)\*\;\<\=\>\?\[\\\]\^\`\{\|\}\~\/\:"):
     return ''.join([c for c in sourcestring if c not in removestring])
-
-def checkBadChat(id, type, path):
-    if type == "videos":
-        fpath = path
-        if os.path.exists(fpath):
-            with open(fpath) as f:
-                if id in f.read():
-                    return True
-                else:
-                    return False
-        else:
-            return False
-            
-    elif type == "clips":
-        fpath = path
-        if os.path.exists(fpath):
-            with open(path) as f:
-                if id in f.read():
-                    return True
-                else:
-                    return False
-        else:
-            return False
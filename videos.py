@@ -1,18 +1,27 @@
 # !/usr/bin/env python3
 
-import twitch  # pip install python-twitch-client
 import yaml  # pip install PyYAML
-from vosk import Model, KaldiRecognizer, SetLogLevel  # pip install vosk
 from discord_webhook import DiscordWebhook # pip install discord-webhook
 
 import os
-import json
 import subprocess
 from datetime import datetime
 import utils
+import http_client
+import helix
+import pipeline
+import chatjson
+import chatassets
+import hls
+import storage
+import transcribe
+import badchat
+import archive_state
 import time
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # importing static-ffmpeg and pre-downloading
 import static_ffmpeg
@@ -25,6 +34,8 @@ with open(config_file) as f:
     conf = yaml.load(f, Loader=yaml.FullLoader)
 client_id = conf["client_id"]
 client_secret = conf["client_secret"]
+storage.configure(conf)
+http_client.configure(conf)
 
 videos_config = path_base + "/config/videos.yaml"
 with open(videos_config) as g:
@@ -33,11 +44,23 @@ channels = videos["channels"]
 max_videos = videos["max_videos"]
 render_chat = videos["render_chat"]
 render_webvtt = videos["render_webvtt"]
+# how each channel's videos are downloaded, "tdcli" (TDCLI videodownload) or "hls" (built in, see hls.py)
+download_engine = videos.get("download_engine", ["tdcli"] * len(channels))
+
+# number of channels to archive at the same time, and how many TDCLI downloads
+# (video or chat) are allowed to run at once across all of those channels
+channel_workers = videos.get("channel_workers", 1)
+max_concurrent_downloads = videos.get("max_concurrent_downloads", 1)
+
+# workers per pipeline stage, any stage not listed gets a single worker
+stage_workers = {"info": 1, "video": 1, "chat": 1, "assets": 1, "transcribe": 1, "render": 1}
+stage_workers.update(videos.get("stage_workers", {}))
 
 # Check for ffmpeg path as installed by static-ffmpeg and the installed version of python/pip
 #   A full path is needed for TwitchDownloader
 
 ffmpeg_path = shutil.which('ffmpeg')
+ffprobe_path = shutil.which('ffprobe')
 
 # ================================================================
 # ================================================================
@@ -47,8 +70,53 @@ tdcli = conf["twitchdownloader"]
 path_twitch_cli = path_base + tdcli
 path_root = videos["video_downloads"]
 badchat_log = videos["video_downloads"] + "badchat.videos"
+badchat_cache = badchat.BadChatCache(badchat_log + ".json", badchat_log)
+# videos whose download failed verification, kept the same way as the chats
+badvideo_cache = badchat.BadChatCache(videos["video_downloads"] + "badvideo.videos.json")
 path_temp = videos["video_temp"]
 
+# what has already been archived, by video id, so we don't have to probe every file on every run
+path_cache = path_base + conf.get("cache_dir", "/cache/")
+os.makedirs(path_cache, exist_ok=True)
+archive = archive_state.ArchiveState(path_cache + "archive_state.db")
+
+# one helix client for every channel, its app token is kept between runs
+helix_client = helix.HelixClient(client_id, client_secret, path_cache + "helix_token.json")
+game_cache = helix.GameCache(path_cache + "games.json", helix_client)
+
+# download the chat of long vods as this many time ranges at once, ranges are at least chat_range_min
+# seconds long and a failed range is tried chat_range_retries more times on its own
+chat_download_ranges = videos.get("chat_download_ranges", 1)
+chat_range_min = videos.get("chat_range_min", 600)
+chat_range_retries = videos.get("chat_range_retries", 2)
+
+# render the chat overlay of long vods as this many segments at once (each at least chat_render_segment_min
+# seconds) and join them without re-encoding, 1 renders the whole vod in one chatrender
+chat_render_workers = videos.get("chat_render_workers", 1)
+chat_render_segment_min = videos.get("chat_render_segment_min", 600)
+render_framerate = 60
+
+# the built in downloader fetches this many segments of a video at once, and at most
+# hls_requests_per_second from any one host
+hls_workers = videos.get("hls_workers", 8)
+hls_requests_per_second = videos.get("hls_requests_per_second", 20)
+
+# a downloaded video shorter than helix says by more than this many seconds is thrown away and tried again
+# later (backing off like a bad chat), after this many attempts a short one is kept and marked partial
+video_duration_tolerance = videos.get("video_duration_tolerance", 10)
+video_verify_attempts = videos.get("video_verify_attempts", 3)
+
+# move the embedded emotes/badges of chat files into a store shared by the channel (<channel>/.assets/)
+chat_asset_store = videos.get("chat_asset_store", False)
+
+# incremental mode only lists videos newer than the newest one of each type archived before
+incremental = videos.get("incremental", False)
+video_types = ["archive", "highlight", "upload"]
+watermarks = utils.JsonStore(path_cache + "watermarks.json")
+
+# chapter moments of vods, fetched in batches per channel
+vod_moments = utils.VodMoments()
+
 # Vosk speech recognition models - 'Small' English model selected by default and recommended.
 #   'Large' model can be used on a system with enough resources including minimum 6GB RAM
 #   free or more and a high end processor.
@@ -56,6 +124,14 @@ path_temp = videos["video_temp"]
 path_model = path_base + "/thirdparty/vosk-model-small-en-us-0.15/"
 #path_model = path_base + "/thirdparty/vosk-model-en-us-0.22/"
 
+# the model is only loaded once a video actually needs transcribing, and then shared by all of them
+model_cache = transcribe.ModelCache(path_model)
+
+# transcribe long videos as windows of audio on several cores at once, 1 reads the whole file as one stream
+transcribe_workers = videos.get("transcribe_workers", 1)
+transcribe_window = videos.get("transcribe_window", 600)
+transcribe_overlap = videos.get("transcribe_overlap", 5)
+
 # ================================================================
 # ================================================================
 
@@ -63,21 +139,21 @@ path_model = path_base + "/thirdparty/vosk-model-small-en-us-0.15/"
 utils.setup_signal_handle()
 
 users = {}
-if len(channels) != len(render_chat) or len(channels) != len(render_webvtt):
+if len(channels) != len(render_chat) or len(channels) != len(render_webvtt) or len(channels) != len(download_engine):
     print('number of channels and chat render settings do not match!!')
     print('\tlen(channels) = %d' % len(channels))
     print('\tlen(users) = %d' % len(users))
     print('\tlen(render_chat) = %d' % len(render_chat))
     print('\tlen(render_webvtt) = %d' % len(render_webvtt))
+    print('\tlen(download_engine) = %d' % len(download_engine))
     exit(-1)
 
 # convert the usernames to ids (sort so the are in the same order)
-client_helix = twitch.TwitchHelix(client_id=client_id, client_secret=client_secret)
-client_helix.get_oauth()
-users_tmp = client_helix.get_users(login_names=channels)
+users_tmp = helix_client.request(lambda client: client.get_users(login_names=channels))
 users = []
 render_chat_tmp = []
 render_webvtt_tmp = []
+download_engine_tmp = []
 for idx, channel in enumerate(channels):
     found = False
     for user in users_tmp:
@@ -85,50 +161,544 @@ for idx, channel in enumerate(channels):
             users.append(user)
             render_chat_tmp.append(render_chat[idx])
             render_webvtt_tmp.append(render_webvtt[idx])
+            download_engine_tmp.append(download_engine[idx])
             found = True
             break
     if not found:
         print("streamer %s wasn't found, are they banned???" % channel)
 render_chat = render_chat_tmp
 render_webvtt = render_webvtt_tmp
-
-# now lets loop through each user and make sure we have downloaded
-# their most recent VODs and if we have not, we should download them!
-for idx, user in enumerate(users):
+download_engine = download_engine_tmp
+
+# who is live right now, checked for every channel at once since their current vod is still growing
+live_user_ids = helix_client.live_user_ids([user["id"] for user in users])
+
+# global cap on TDCLI downloads, shared by all channel workers
+download_slots = threading.BoundedSemaphore(max(1, max_concurrent_downloads))
+
+
+def make_job(idx, user, path_data, video, log):
+
+    # DATA: api data of this vod
+    video_data = {
+        'id': video['helix']['id'],
+        'user_id': video['helix']['user_id'],
+        'user_name': video['helix']['user_name'],
+        'title': video['helix']['title'],
+        'type': video['helix']['type'],
+        'duration': video['helix']['duration'],
+        'url': video['helix']['url'],
+        'views': video['helix']['view_count'],
+        'muted_segments': (video['helix']['muted_segments'] if video['helix']['muted_segments'] != None else []),
+        'recorded_at': video['helix']['created_at'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'recorded_at_iso': video['helix']['created_at'].strftime('%Y%m%d T%H%M%SZ')
+    }
+
+    # providing a single source for all filename calls in this script, including stripping illegal characters
+    filename_format = utils.cleanFilename(str(video_data['recorded_at_iso']) + " - " + str(video['helix']['id']) + " - " + str(video['helix']['title']) + "_" + str(video['helix']['type']))
+
+    # a video we've seen before keeps the filenames it was first saved under, even if it got renamed since
+    path_out = archive.get_base(video['helix']['id'])
+    if path_out is None:
+        # extract what folder we should save into
+        try:
+            date = datetime.strptime(video_data['recorded_at'], '%Y-%m-%dT%H:%M:%SZ')
+            export_folder = format(date.year, '02') + "-" + format(date.month, '02') + "/"
+        except:
+            export_folder = "unknown/"
+        path_out = path_data + export_folder + filename_format
+        archive.set_base(video['helix']['id'], path_out)
+    # create the folder if it isn't created already
+    os.makedirs(os.path.dirname(path_out), exist_ok=True)
+
+    job = pipeline.Job(str(video['helix']['id']), log, {
+        'idx': idx,
+        'helix': video['helix'],
+        'video_data': video_data,
+        't0_start': time.time(),
+        'info': path_out + "_info.json",
+        'video': path_out + ".mp4",
+        'chat': path_out + "_chat.json",
+        'srt': path_out + ".srt",
+        'render': path_out + "_chat.mp4",
+        'assets': path_data + ".assets/",
+    })
+
+    # the srt needs the mp4 and the render needs the chat log, everything else can start right away
+    job.add("info", leased("info", stage_info))
+    job.add("video", leased("video", stage_video))
+    job.add("chat", leased("chat", stage_chat))
+    if chat_asset_store:
+        job.add("assets", leased("assets", stage_assets), deps=["chat"])
+    if render_webvtt[idx]:
+        job.add("transcribe", leased("transcribe", stage_transcribe), deps=["video"])
+    if render_chat[idx]:
+        job.add("render", leased("render", stage_render), deps=["assets"] if chat_asset_store else ["chat"])
+    return job
+
+
+def leased(stage, fn):
+    # a stage only runs while this run holds the lease on it, so a run cron started while the
+    # last one is still going skips what that one is working on (and the watermark stays below it)
+    def run(job):
+        lease_id = job.name + "/" + stage
+        if not archive.acquire(lease_id):
+            job.log("\t- " + stage + " of " + job.name + " is being archived by another run, skipping it")
+            return False
+        try:
+            return fn(job)
+        finally:
+            archive.release(lease_id)
+    return run
+
+
+def artifact_state(job, kind):
+    # the state db answers for anything archived before, it only looks on disk for the rest
+    state, job.data[kind] = archive.lookup(job.name, kind, job.data[kind])
+    return state
+
+
+def artifact_done(job, kind, state=archive_state.COMPLETE, detail="download"):
+    archive.record(job.name, kind, job.data[kind], state=state, detail=detail)
+    job.artifacts[kind] = job.data[kind]
+    return True
+
+
+def stage_info(job):
+
+    # INFO: nothing to do once the info is complete, otherwise (re)write it
+    video_id = job.data['helix']['id']
+    state = artifact_state(job, 'info')
+    if state == archive_state.COMPLETE:
+        job.artifacts['info'] = job.data['info']
+        return True
+    file_path_info = job.data['info']
+    if state is None:
+        job.log("\t- saving video info: " + file_path_info)
+        video_info = dict(job.data['video_data'])
+        video_info['moments'] = vod_moments.get(video_id)
+    else:
+        job.log("\t- updating video info: " + file_path_info)
+        video_info = storage.load_json(file_path_info)
+        # update moments if failed before
+        moments = vod_moments.get(video_id)
+        if len(moments) != 0:
+            video_info["moments"] = moments
+    # finally write to file
+    storage.write_json(file_path_info, video_info)
+    # keep retrying the moments on later runs until twitch gives us some
+    return artifact_done(job, 'info', archive_state.COMPLETE if len(video_info["moments"]) != 0 else archive_state.PARTIAL)
+
+
+def video_temp_dir(video_id):
+    # everything a video download writes goes in here, and is only removed once the video is archived
+    return path_temp + str(video_id) + "_video/"
+
+
+def verify_video(job, file_path):
+    # a download that was cut off is shorter than the vod, helix knows how long it should be
+    # returns the measured duration (None without ffprobe) and what is wrong with the file, if anything
+    if ffprobe_path is None:
+        job.log("\t- no ffprobe to check the download with, keeping it unverified")
+        return None, None
+    expected = utils.duration_to_seconds(job.data['helix']['duration'])
+    duration = utils.get_media_duration(file_path, ffprobe_path)
+    # e.g. an mp4 that was cut off before its moov atom was written
+    if duration < 0:
+        return duration, "ffprobe could not read the download"
+    if duration < expected - video_duration_tolerance:
+        return duration, "download is " + str(round(duration)) + " of " + str(expected) + " seconds long"
+    return duration, None
+
+
+def publish_video(file_path_tmp, file_path):
+    # the temp dir can be on another disk, copy next to the target first so the rename is atomic
+    if os.path.dirname(os.path.abspath(file_path_tmp)) != os.path.dirname(os.path.abspath(file_path)):
+        shutil.move(file_path_tmp, file_path + ".part")
+        file_path_tmp = file_path + ".part"
+    os.replace(file_path_tmp, file_path)
+
+
+def download_video_tdcli(video_id, file_path_tmp, temp_dir):
+    # TDCLI starts over in a new folder of its own every time, what an earlier attempt left is no use to it
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    cmd = path_twitch_cli + ' videodownload' \
+          + ' --id ' + video_id + ' --ffmpeg-path "' + ffmpeg_path + '"' \
+          + ' --temp-path "' + temp_dir + '" -o "' + file_path_tmp + '"'
+    # print("CMD: " + str(cmd))
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proc.wait()
+    # subprocess.Popen(cmd, shell=True).wait()
+    return proc.returncode == 0
+
+
+def download_video_hls(job, video_id, file_path_tmp, temp_dir):
+    # the segments stay in the temp dir until the video is archived, so a new run picks up where this one stopped
+    try:
+        playlist_url = hls.vod_playlist_url(video_id)
+        return hls.download(playlist_url, file_path_tmp, temp_dir + "segments/", ffmpeg_path,
+                            workers=hls_workers, per_host=hls_requests_per_second, log=job.log)
+    except Exception as e:
+        job.log("\t- ERR: " + str(e))
+        return False
+
+
+def stage_video(job):
+
+    # VIDEO: check if the file exists, a partial one is as good as it got
+    if artifact_state(job, 'video') in (archive_state.COMPLETE, archive_state.PARTIAL):
+        job.artifacts['video'] = job.data['video']
+        return True
+    file_path = job.data['video']
+    video_id = str(job.data['helix']['id'])
+    if badvideo_cache.should_skip(video_id):
+        entry = badvideo_cache.get(video_id)
+        job.log("\t- last download was no good (" + entry['reason'] + "), next try after "
+                + datetime.fromtimestamp(entry['retry_after']).strftime('%Y-%m-%d %H:%M'))
+        return False
+    temp_dir = video_temp_dir(video_id)
+    file_path_tmp = temp_dir + video_id + ".mp4"
+    # only a download that was verified is ever moved to file_path, so a file there is complete
+    job.log("\t- download video: " + file_path)
+    with download_slots:
+        t0 = time.time()
+        if download_engine[job.data['idx']] == "hls":
+            downloaded = download_video_hls(job, video_id, file_path_tmp, temp_dir)
+        else:
+            downloaded = download_video_tdcli(video_id, file_path_tmp, temp_dir)
+        job.log("\t- done in " + str(time.time() - t0) + " seconds")
+    if not downloaded or not os.path.exists(file_path_tmp):
+        return False
+    duration, error = verify_video(job, file_path_tmp)
+    if error is not None:
+        entry = badvideo_cache.add(video_id, error)
+        job.log("\t- ERR: " + error + " (attempt " + str(entry['attempts']) + ")")
+        if duration < 0 or entry['attempts'] < video_verify_attempts:
+            os.remove(file_path_tmp)
+            job.log("\t- trying it again after " + datetime.fromtimestamp(entry['retry_after']).strftime('%Y-%m-%d %H:%M'))
+            return False
+        # twitch keeps handing out the same short video, keep it instead of downloading it over and over
+        job.log("\t- keeping the short download as partial")
+    publish_video(file_path_tmp, file_path)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    badvideo_cache.remove(video_id)
+    if error is not None:
+        return artifact_done(job, 'video', archive_state.PARTIAL, detail=error)
+    return artifact_done(job, 'video')
+
+
+def time_ranges(duration, count, min_length):
+    # split the vod into up to count parts of whole seconds, each at least min_length seconds
+    count = min(count, int(duration // min_length)) if duration > 0 else 1
+    if count <= 1:
+        return [(0, duration)]
+    step = int(duration // count) + 1
+    return [(start, min(start + step, duration)) for start in range(0, int(duration), step)]
+
+
+def download_chat_range(video_id, begin, end, file_path):
+    # one chatdownload, of the whole vod or just [begin, end) of it, returns why it failed
+    cmd = path_twitch_cli + ' chatdownload' \
+          + ' --id ' + str(video_id) + ' -E'
+    if begin is not None:
+        cmd += ' -b ' + str(begin)
+    if end is not None:
+        cmd += ' -e ' + str(end)
+    cmd += ' -o ' + file_path
+    # print("CMD: " + str(cmd))
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proc.wait()
+    if proc.returncode != 0:
+        return "chatdownload exited with " + str(proc.returncode)
+    return None
+
+
+def download_chat_ranges(job, video_id, ranges, file_path_chat):
+    # download the time ranges of the chat at the same time and merge them into one file
+    # a range is retried on its own, and finished ranges are kept so the next run only redoes the rest
+    paths = [path_temp + str(video_id) + "_chat_part" + str(i) + ".json" for i in range(len(ranges))]
+
+    def download(i):
+        if os.path.exists(paths[i]):
+            return None
+        path_tmp = path_temp + str(video_id) + "_chat_part" + str(i) + ".tmp.json"
+        # the last range runs to the end in case the vod is a little longer than helix says
+        end = ranges[i][1] if i + 1 < len(ranges) else None
+        error = None
+        for attempt in range(1 + chat_range_retries):
+            if utils.terminated_requested:
+                return "terminated"
+            # every range is a TDCLI download of its own and counts against max_concurrent_downloads
+            with download_slots:
+                error = download_chat_range(video_id, ranges[i][0], end, path_tmp)
+            if error is None and os.path.exists(path_tmp):
+                os.replace(path_tmp, paths[i])
+                return None
+            job.log("\t- chat range " + str(ranges[i][0]) + "-" + str(ranges[i][1]) + " failed (attempt "
+                    + str(attempt + 1) + "): " + str(error))
+        return "range " + str(ranges[i][0]) + "-" + str(ranges[i][1]) + ": " + str(error)
+
+    job.log("\t- downloading chat as " + str(len(ranges)) + " ranges")
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        errors = [error for error in executor.map(download, range(len(ranges))) if error is not None]
+    if len(errors) > 0:
+        return errors[0]
+    count = chatjson.merge_ranges(paths, ranges, file_path_chat)
+    job.log("\t- merged " + str(count) + " comments")
+    for path in paths:
+        os.remove(path)
+    return None
+
+
+def stage_chat(job):
+
+    # CHAT: check if the file exists
+    if artifact_state(job, 'chat') == archive_state.COMPLETE:
+        job.artifacts['chat'] = job.data['chat']
+        return True
+    video_id = job.data['helix']['id']
+    file_path_chat = job.data['chat']
+    file_path_chat_tmp = path_temp + str(video_id) + "_chat.json"
+    if badchat_cache.should_skip(video_id):
+        entry = badchat_cache.get(video_id)
+        job.log("\t- chat known bad (" + entry['reason'] + "), next try after "
+                + datetime.fromtimestamp(entry['retry_after']).strftime('%Y-%m-%d %H:%M'))
+        job.data['badchat'] = True
+        return False
+    job.log("\t- download chat: " + file_path_chat)
+    ranges = time_ranges(utils.duration_to_seconds(job.data['helix']['duration']), chat_download_ranges, chat_range_min)
+    t0 = time.time()
+    # Attempt to download chat log. If it fails we'll assume there's no chat log at all for this video
+    #   and remember that in the bad chat cache, which backs off before trying this video again.
+    if len(ranges) > 1:
+        error = download_chat_ranges(job, video_id, ranges, file_path_chat_tmp)
+    else:
+        with download_slots:
+            error = download_chat_range(video_id, None, None, file_path_chat_tmp)
+    if error is not None and utils.terminated_requested:
+        # killed by our own ctrl+c, that doesn't say anything about the chat
+        return False
+    if error is not None or not os.path.exists(file_path_chat_tmp):
+        entry = badchat_cache.add(video_id, error if error is not None else "chatdownload wrote no file")
+        job.log("ERR: Video has no chat. Either nothing was said or the source VOD is no longer available. Attempt "
+                + str(entry['attempts']) + ", skipping it until "
+                + datetime.fromtimestamp(entry['retry_after']).strftime('%Y-%m-%d %H:%M'))
+        job.data['badchat'] = True
+        return False
+    job.log("GOOD: File moved")
+    badchat_cache.remove(video_id)
+    storage.publish(file_path_chat_tmp, file_path_chat)
+    job.log("\t- done in " + str(time.time() - t0) + " seconds")
+    return artifact_done(job, 'chat')
+
+
+def stage_assets(job):
+
+    # ASSETS: keep the embedded emotes and badges once per channel instead of in every chat file
+    file_path_chat = job.artifacts['chat']
+    # the state db knows if this chat went through the store since it was last written, no need to open it
+    chat = archive.get(job.name, 'chat')
+    assets = archive.get(job.name, 'assets')
+    if chat is not None and (chat['detail'] == "assets"
+                             or (assets is not None and assets['updated_at'] >= chat['updated_at'])):
+        return True
+    t0 = time.time()
+    saved = chatassets.dehydrate(file_path_chat, job.data['assets'])
+    # clips.py slices clip chat out of this file and needs to know where its assets went
+    archive.record(job.data['helix']['id'], 'assets', job.data['assets'], detail="store")
+    if saved is not None:
+        archive.record(job.data['helix']['id'], 'chat', file_path_chat, detail="assets")
+        job.log("\t- moved embedded assets to the channel store, chat file now "
+                + str(os.path.getsize(file_path_chat) // 1024) + " KB (" + str(saved // 1024) + " KB saved) in "
+                + str(time.time() - t0) + " seconds")
+    return True
+
+
+def stage_transcribe(job):
+
+    # AUDIO-TO-TEXT: check if file exists
+    if artifact_state(job, 'srt') == archive_state.COMPLETE:
+        job.artifacts['srt'] = job.data['srt']
+        return True
+    file_path = job.artifacts['video']
+    file_path_webvtt = job.data['srt']
+    job.log("\t- transcribing: " + file_path_webvtt)
+    t0 = time.time()
+    duration = utils.duration_to_seconds(job.data['helix']['duration'])
+    if not transcribe.transcribe_srt_parallel(model_cache, ffmpeg_path, file_path, file_path_webvtt, duration,
+                                              transcribe_workers, transcribe_window, transcribe_overlap):
+        return False
+    job.log("\t- done in " + str(time.time() - t0) + " seconds")
+
+    # send pushover that this twitch vod is ready to edit
+    text = job.data['helix']['user_name'] + " vod " + str(job.data['helix']['id']) \
+            + " ready to edit (" + str(int((time.time() - job.data['t0_start'])/60.0)) + " min to prepare)"
+    utils.send_pushover_message(conf, text)
+    return artifact_done(job, 'srt')
+
+
+def run_chatrender(file_path_chat, file_path_out, temp_dir, begin=None, end=None):
+    # one chatrender, of the whole chat or just [begin, end) of it
+    cmd = path_twitch_cli + ' chatrender' \
+          + ' -i "' + file_path_chat + '" --ffmpeg-path "' + ffmpeg_path + '"' \
+          + ' -h 926 -w 274 --update-rate 0.1 --framerate ' + str(render_framerate) + ' --font-size 15'
+    if begin is not None:
+        cmd += ' -b ' + str(begin)
+    if end is not None:
+        cmd += ' -e ' + str(end)
+    cmd += ' --temp-path "' + temp_dir + '" -o ' + file_path_out
+    # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
+    proc = subprocess.Popen(cmd, shell=True)
+    proc.wait()
+    return proc.returncode == 0 and os.path.exists(file_path_out)
+
+
+def render_chat_segments(job, file_path_chat, ranges, file_path_render):
+    # render time ranges of the chat at the same time and join them without re-encoding
+    # the ranges are whole seconds, so at a fixed framerate every seam falls on a frame
+    video_id = str(job.data['helix']['id'])
+    paths = [path_temp + video_id + "_chat_seg" + str(i) + ".mp4" for i in range(len(ranges))]
+    job.log("\t- rendering chat as " + str(len(ranges)) + " segments")
+
+    def render(i):
+        if utils.terminated_requested:
+            return False
+        # every render gets its own temp folder so their scratch files can't collide
+        temp_dir = path_temp + video_id + "_render" + str(i) + "/"
+        os.makedirs(temp_dir, exist_ok=True)
+        # the last segment runs to the end of the chat
+        end = ranges[i][1] if i + 1 < len(ranges) else None
+        rendered = run_chatrender(file_path_chat, paths[i], temp_dir, ranges[i][0], end)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return rendered
+
+    def cleanup():
+        for path in paths + [path_temp + video_id + "_chat_seg.txt"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        rendered = list(executor.map(render, range(len(ranges))))
+    if not all(rendered):
+        job.log("ERR: segments " + str([i for i in range(len(ranges)) if not rendered[i]]) + " failed to render")
+        cleanup()
+        return False
+
+    # every segment but the last has to be exactly as many frames long as its range
+    frames = [utils.count_video_frames(path, ffprobe_path) for path in paths] if ffprobe_path is not None else None
+    if frames is not None:
+        for i in range(len(ranges) - 1):
+            expected = (ranges[i][1] - ranges[i][0]) * render_framerate
+            if frames[i] != expected:
+                job.log("ERR: chat segment " + str(i) + " has " + str(frames[i]) + " frames, expected " + str(expected))
+                cleanup()
+                return False
+
+    # concat demuxer, the segments share their encoding settings so the streams can just be copied
+    file_path_list = path_temp + video_id + "_chat_seg.txt"
+    with open(file_path_list, "w") as f:
+        for path in paths:
+            f.write("file '" + path.replace("'", "'\\''") + "'\n")
+    proc = subprocess.run([ffmpeg_path, "-nostdin", "-loglevel", "error", "-y", "-f", "concat", "-safe", "0",
+                           "-i", file_path_list, "-c", "copy", file_path_render],
+                          stdout=subprocess.DEVNULL)
+    cleanup()
+    if proc.returncode != 0 or not os.path.exists(file_path_render):
+        job.log("ERR: joining the chat segments failed")
+        return False
+    if frames is not None:
+        total = utils.count_video_frames(file_path_render, ffprobe_path)
+        if total != sum(frames):
+            job.log("ERR: joined chat render has " + str(total) + " frames, the segments have " + str(sum(frames)))
+            os.remove(file_path_render)
+            return False
+    else:
+        job.log("\t- no ffprobe, not checking the frame count of the joined render")
+    return True
+
+
+def stage_render(job):
+
+    # RENDER: check if the file exists
+    if artifact_state(job, 'render') == archive_state.COMPLETE:
+        job.artifacts['render'] = job.data['render']
+        return True
+    file_path_chat = job.artifacts['chat']
+    file_path_render = job.data['render']
+    file_path_render_tmp = path_temp + str(job.data['helix']['id']) + "_chat.mp4"
+    job.log("\t- rendering chat: " + file_path_render)
+    t0 = time.time()
+    # chatrender wants a plain chat file with the emotes and badges inside
+    file_path_chat_full = None
+    if chatassets.is_dehydrated(file_path_chat):
+        file_path_chat_full = path_temp + str(job.data['helix']['id']) + "_chat_full.json"
+        chatassets.rehydrate(file_path_chat, file_path_chat_full, job.data['assets'])
+        file_path_chat = file_path_chat_full
+    elif storage.sniff(file_path_chat) is not None:
+        file_path_chat_full = path_temp + str(job.data['helix']['id']) + "_chat_full.json"
+        storage.plain_copy(file_path_chat, file_path_chat_full)
+        file_path_chat = file_path_chat_full
+    ranges = time_ranges(utils.duration_to_seconds(job.data['helix']['duration']), chat_render_workers, chat_render_segment_min)
+    if len(ranges) > 1:
+        rendered = render_chat_segments(job, file_path_chat, ranges, file_path_render_tmp)
+    else:
+        rendered = run_chatrender(file_path_chat, file_path_render_tmp, path_temp)
+    if file_path_chat_full is not None:
+        os.remove(file_path_chat_full)
+    if not rendered:
+        return False
+    shutil.move(file_path_render_tmp, file_path_render)
+    job.log("\t- done in " + str(time.time() - t0) + " seconds")
+    return artifact_done(job, 'render')
+
+
+def process_channel(idx, user):
 
     # check if we should download any more
     if utils.terminated_requested:
-        print('terminate requested, not looking at any more users...')
-        break
+        return
+    log = utils.channel_logger(user["login"].lower())
 
     # check if the directory is created
     path_data = path_root + "/" + user["login"].lower() + "/"
-    if not os.path.exists(path_data):
-        os.makedirs(path_data)
-    if not os.path.exists(path_temp):
-        os.makedirs(path_temp)
-
-    # get this stream object, it will have something if the stream is live
-    client_helix = twitch.TwitchHelix(client_id=client_id, client_secret=client_secret)
-    client_helix.get_oauth()
-    stream = client_helix.get_streams(user_ids=[user["id"]])
-    stream_is_live = (len(stream) == 1)
-
-    # get the videos for this specific user
-    print("getting videos for -> " + user["login"].lower() + " (id " + str(user["id"]) + ")")
-    vid_iter = client_helix.get_videos(user_id=user["id"], page_size=100)
+    os.makedirs(path_data, exist_ok=True)
+    os.makedirs(path_temp, exist_ok=True)
+
+    # the stream is live if it was in the batched lookup at startup
+    stream_is_live = str(user["id"]) in live_user_ids
+
+    # get the videos for this specific user, newest first
+    # in incremental mode anything at or below the watermark of its type was archived by an earlier run
+    log("getting videos for -> " + user["login"].lower() + " (id " + str(user["id"]) + ")")
+    marks = {}
+    for video_type in video_types:
+        marks[video_type] = watermarks.get(str(user["id"]) + "/" + video_type) if incremental else None
+    vid_iter = helix_client.request(lambda client: client.get_videos(user_id=user["id"], page_size=100))
     arr_archive = []
     arr_highlight = []
     arr_upload = []
     ct_added = [0, 0, 0]
     seen_first_video = False
+    live_video_id = None
+    newest_listed = None
     for video in vid_iter:
+        video_id = int(video['id'])
+        newest_listed = video_id if newest_listed is None else max(newest_listed, video_id)
+        # stop paging once every type is either full or down to its watermark
+        if all(ct_added[i] >= max_videos or (marks[video_type] is not None and video_id <= marks[video_type])
+               for i, video_type in enumerate(video_types)):
+            break
         # skip the first VOD is they are live
         if not seen_first_video and stream_is_live:
-            print("skipping video " + video['id'] + " since stream is live...")
+            log("skipping video " + video['id'] + " since stream is live...")
             seen_first_video = True
+            live_video_id = video_id
             continue
         seen_first_video = True
+        if marks.get(video['type']) is not None and video_id <= marks[video['type']]:
+            continue
         # else lets process
         # "all", "upload", "archive", "highlight"
         if video['type'] == 'archive' and ct_added[0] < max_videos:
@@ -140,443 +710,135 @@ for idx, user in enumerate(users):
         elif video['type'] == 'upload' and ct_added[2] < max_videos:
             arr_upload.append({'helix': video})
             ct_added[2] = ct_added[2] + 1
+        if all(count >= max_videos for count in ct_added):
+            break
 
     # nice debug print
-    print("\t- found " + str(len(arr_archive)) + " archives")
-    print("\t- found " + str(len(arr_highlight)) + " highlights")
-    print("\t- found " + str(len(arr_upload)) + " uploads")
-
-    # loop through each archive/VOD and download
-    for video in arr_archive:
-
-        # check if we should download any more
-        if utils.terminated_requested:
-            print('terminate requested, not downloading any more..')
-            break
+    log("\t- found " + str(len(arr_archive)) + " archives")
+    log("\t- found " + str(len(arr_highlight)) + " highlights")
+    log("\t- found " + str(len(arr_upload)) + " uploads")
+
+    # vods the watermark passed with a bad chat get their chat tried again once its backoff is over,
+    # the ones twitch deleted since are dropped along with the chat ranges they left behind
+    arr_badchat = []
+    if incremental:
+        listed = set(video['helix']['id'] for video in arr_archive + arr_highlight + arr_upload)
+        retry_ids = [video_id for video_id in watermarks.get(str(user["id"]) + "/badchat", [])
+                     if video_id not in listed and not badchat_cache.should_skip(video_id)]
+        if len(retry_ids) > 0:
+            arr_badchat = [{'helix': video} for video in helix_client.videos_by_id(retry_ids)]
+            found = set(video['helix']['id'] for video in arr_badchat)
+            gone = [video_id for video_id in retry_ids if video_id not in found]
+            for video_id in gone:
+                remove_chat_parts(video_id)
+            update_badchat(user, [], gone)
+            log("\t- trying the chat of " + str(len(arr_badchat)) + " older videos again, "
+                + str(len(gone)) + " are gone")
+
+    # look up the moments of every vod whose info still needs them in as few requests as possible
+    info_needed = [video['helix']['id'] for video in arr_archive + arr_highlight + arr_upload
+                   if not archive.is_complete(video['helix']['id'], 'info')]
+    vod_moments.prefetch(info_needed)
+    # the moments name their games, clips.py can use those instead of asking helix
+    game_cache.seed(dict((moment['id'], moment['name']) for video_id in info_needed
+                         for moment in vod_moments.get(video_id)))
+
+    # queue each archive/VOD, then highlight, then upload into the pipeline
+    # the stage pools work through them in order, so video N+1 downloads while N is transcribed
+    jobs = []
+    for video in arr_archive + arr_highlight + arr_upload:
+        jobs.append(video_pipeline.submit(make_job(idx, user, path_data, video, log)))
+    retried = [video_pipeline.submit(make_job(idx, user, path_data, video, log)) for video in arr_badchat]
+    for job in jobs + retried:
+        job.wait()
+    if utils.terminated_requested:
+        log('terminate requested, not downloading any more..')
+    if incremental:
+        update_watermarks(user, marks, jobs, live_video_id, newest_listed, log)
+        update_badchat(user, jobs + retried, [])
 
-        # DATA: api data of this vod
-        t0_start = time.time()
-        video_data = {
-            'id': video['helix']['id'],
-            'user_id': video['helix']['user_id'],
-            'user_name': video['helix']['user_name'],
-            'title': video['helix']['title'],
-            'type': video['helix']['type'],
-            'duration': video['helix']['duration'],
-            'url': video['helix']['url'],
-            'views': video['helix']['view_count'],
-            'moments': utils.get_vod_moments(video['helix']['id']),
-            'muted_segments': (video['helix']['muted_segments'] if video['helix']['muted_segments'] != None else []),
-            'recorded_at': video['helix']['created_at'].strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'recorded_at_iso': video['helix']['created_at'].strftime('%Y%m%d T%H%M%SZ')
-        }
-
-        # providing a single source for all filename calls in this script, including stripping illegal characters
-        filename_format = utils.cleanFilename(str(video_data['recorded_at_iso']) + " - " + str(video['helix']['id']) + " - " + str(video['helix']['title']) + "_" + str(video['helix']['type']))
 
-        # extract what folder we should save into
-        # create the folder if it isn't created already
-        try:
-            date = datetime.strptime(video_data['recorded_at'], '%Y-%m-%dT%H:%M:%SZ')
-            export_folder = format(date.year, '02') + "-" + format(date.month, '02') + "/"
-        except:
-            export_folder = "unknown/"
-        if not os.path.exists(path_data + export_folder):
-            os.makedirs(path_data + export_folder)
-
-        # VIDEO: check if the file exists
-        file_path_info = path_data + export_folder + filename_format + "_info.json"
-        print("\t- saving video info: " + file_path_info)
-        if not utils.terminated_requested and not os.path.exists(file_path_info):
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_data, file, indent=4)
-        elif not utils.terminated_requested:
-            print("\t- updating video info: " + file_path_info)
-            with open(file_path_info) as f:
-                video_info = json.load(f)
-            # update moments if failed before
-            if len(video_info["moments"]) == 0:
-                moments = utils.get_vod_moments(video['helix']['id'])
-                if len(moments) != 0:
-                    video_info["moments"] = moments
-            # finally write to file
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_info, file, indent=4)
-
-        # VIDEO: check if the file exists
-        file_path = path_data + export_folder + filename_format + ".mp4"
-        print("\t- download video: " + file_path)
-        if not utils.terminated_requested and not os.path.exists(file_path):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' videodownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' --temp-path "' + path_temp + '" -o "' + file_path + '"'
-            # print("CMD: " + str(cmd))
-            subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            # subprocess.Popen(cmd, shell=True).wait()
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # CHAT: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_bad = file_path_chat + ".BAD"
-        file_path_chat_tmp = path_temp + str(video['helix']['id']) + "_chat.json"
-        print("\t- download chat: " + file_path_chat)
-        if not utils.terminated_requested and (not os.path.exists(file_path_chat) or utils.checkBadChat(video['helix']['id'], "clips", badchat_log)):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatdownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' -E' \
-                  + ' -o ' + file_path_chat_tmp
-            # print("CMD: " + str(cmd))
-            # Attempt to download chat log. If the first attempt with emojis embedded fails, try again without emojis. TDCLI will error out
-            #   there's issues with downloading emojis. We'd rather download the log without them than fail entirely.
-            #
-            # If the no-emoji attempt fails as well, we'll assume there's no chat log at all for this video. We'll write a blank .BAD file
-            #   to satisfy future file-exists checks.
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            proc.wait()
-            if proc.returncode != 0:
-                print("ERR: Clip has no chat. Either nothing was said or the source VOD is no longer available. Inserting placeholder.")               
-                with open(badchat_log, 'a') as fp:
-                    fp.write(str(video['helix']['id']))
-                    fp.write('\n')
-            else:
-                print("GOOD: File moved")
-                if os.path.exists(file_path_chat_tmp):
-                    shutil.move(file_path_chat_tmp, file_path_chat)
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # AUDIO-TO-TEXT: check if file exists
-        file_path_webvtt = path_data + export_folder + filename_format + ".srt"
-        if not utils.terminated_requested and os.path.exists(file_path) and not os.path.exists(file_path_webvtt) and render_webvtt[idx]:
-            print("\t- transcribing: " + file_path_webvtt)
-            t0 = time.time()
-
-            # open the model
-            SetLogLevel(-1)
-            sample_rate = 16000
-            # words_per_line = 7
-            model = Model(path_model)
-            rec = KaldiRecognizer(model, sample_rate)
-            rec.SetWords(True)
-
-            with subprocess.Popen([ffmpeg_path, "-loglevel", "quiet", "-i",
-                            file_path,
-                            "-ar", str(sample_rate) , "-ac", "1", "-f", "s16le", "-"],
-                            stdout=subprocess.PIPE).stdout as stream:
-
-                with open(file_path_webvtt, 'w') as f:
-                    f.write(rec.SrtResult(stream))
-            
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-            # send pushover that this twitch vod is ready to edit
-            text = video['helix']['user_name'] + " vod " + str(video['helix']['id']) \
-                    + " ready to edit (" + str(int((time.time() - t0_start)/60.0)) + " min to prepare)"
-            utils.send_pushover_message(conf, text)
-
-        # RENDER: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_path_render = path_data + export_folder + filename_format + "_chat.mp4"
-        file_path_render_tmp = path_temp + str(video['helix']['id']) + "_chat.mp4"
-        if not utils.terminated_requested and os.path.exists(file_path_chat) and not os.path.exists(file_path_render) and render_chat[idx]:
-            print("\t- rendering chat: " + file_path_render)
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatrender' \
-                  + ' -i ' + file_path_chat + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' -h 926 -w 274 --update-rate 0.1 --framerate 60 --font-size 15' \
-                  + ' --temp-path "' + path_temp + '" -o ' + file_path_render_tmp
-            # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            subprocess.Popen(cmd, shell=True).wait()
-            if os.path.exists(file_path_render_tmp):
-                shutil.move(file_path_render_tmp, file_path_render) 
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-    # loop through each highlight and download
-    for video in arr_highlight:
-
-        # check if we should download any more
-        if utils.terminated_requested:
-            print('terminate requested, not downloading any more..')
-            break
+# stages that can't be done for a vod without a chat log
+chat_stages = ("chat", "assets", "render")
 
-        # DATA: api data of this vod
-        t0_start = time.time()
-        video_data = {
-            'id': video['helix']['id'],
-            'user_id': video['helix']['user_id'],
-            'user_name': video['helix']['user_name'],
-            'title': video['helix']['title'],
-            'type': video['helix']['type'],
-            'duration': video['helix']['duration'],
-            'url': video['helix']['url'],
-            'views': video['helix']['view_count'],
-            'moments': utils.get_vod_moments(video['helix']['id']),
-            'muted_segments': (video['helix']['muted_segments'] if video['helix']['muted_segments'] != None else []),
-            'recorded_at': video['helix']['created_at'].strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'recorded_at_iso': video['helix']['created_at'].strftime('%Y%m%d T%H%M%SZ')
-        }
-
-        # providing a single source for all filename calls in this script, including stripping illegal characters
-        filename_format = utils.cleanFilename(str(video_data['recorded_at_iso']) + " - " + str(video['helix']['id']) + " - " + str(video['helix']['title']) + "_" + str(video['helix']['type']))
 
-        # extract what folder we should save into
-        # create the folder if it isn't created already
-        try:
-            date = datetime.strptime(video_data['recorded_at'], '%Y-%m-%dT%H:%M:%SZ')
-            export_folder = format(date.year, '02') + "-" + format(date.month, '02') + "/"
-        except:
-            export_folder = "unknown/"
-        if not os.path.exists(path_data + export_folder):
-            os.makedirs(path_data + export_folder)
-
-        # VIDEO: check if the file exists
-        file_path_info = path_data + export_folder + filename_format + "_info.json"
-        print("\t- saving video info: " + file_path_info)
-        if not utils.terminated_requested and not os.path.exists(file_path_info):
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_data, file, indent=4)
-        elif not utils.terminated_requested:
-            print("\t- updating video info: " + file_path_info)
-            with open(file_path_info) as f:
-                video_info = json.load(f)
-            # update moments if failed before
-            if len(video_info["moments"]) == 0:
-                moments = utils.get_vod_moments(video['helix']['id'])
-                if len(moments) != 0:
-                    video_info["moments"] = moments
-            # finally write to file
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_info, file, indent=4)
-
-        # VIDEO: check if the file exists
-        file_path = path_data + export_folder + filename_format + ".mp4"
-        print("\t- download video: " + file_path)
-        if not utils.terminated_requested and not os.path.exists(file_path):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' videodownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' --temp-path "' + path_temp + '" -o "' + file_path + '"'
-            # print("CMD: " + str(cmd))
-            subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            # subprocess.Popen(cmd, shell=True).wait()
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # CHAT: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_bad = file_path_chat + ".BAD"
-        file_path_chat_tmp = path_temp + str(video['helix']['id']) + "_chat.json"
-        print("\t- download chat: " + file_path_chat)
-        if not utils.terminated_requested and (not os.path.exists(file_path_chat) or utils.checkBadChat(video['helix']['id'], "clips", badchat_log)):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatdownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' -E' \
-                  + ' -o ' + file_path_chat_tmp
-            # print("CMD: " + str(cmd))
-            # Attempt to download chat log. If the first attempt with emojis embedded fails, try again without emojis. TDCLI will error out
-            #   there's issues with downloading emojis. We'd rather download the log without them than fail entirely.
-            #
-            # If the no-emoji attempt fails as well, we'll assume there's no chat log at all for this video. We'll write a blank .BAD file
-            #   to satisfy future file-exists checks.
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            proc.wait()
-            if proc.returncode != 0:
-                print("ERR: Clip has no chat. Either nothing was said or the source VOD is no longer available. Inserting placeholder.")               
-                with open(badchat_log, 'a') as fp:
-                    fp.write(str(video['helix']['id']))
-                    fp.write('\n')
-            else:
-                print("GOOD: File moved")
-                if os.path.exists(file_path_chat_tmp):
-                    shutil.move(file_path_chat_tmp, file_path_chat)
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # AUDIO-TO-TEXT: check if file exists
-        file_path_webvtt = path_data + export_folder + filename_format + ".srt"
-        if not utils.terminated_requested and os.path.exists(file_path) and not os.path.exists(file_path_webvtt) and render_webvtt[idx]:
-            print("\t- transcribing: " + file_path_webvtt)
-            t0 = time.time()
-
-            # open the model
-            SetLogLevel(-1)
-            sample_rate = 16000
-            # words_per_line = 7
-            model = Model(path_model)
-            rec = KaldiRecognizer(model, sample_rate)
-            rec.SetWords(True)
-
-            with subprocess.Popen([ffmpeg_path, "-loglevel", "quiet", "-i",
-                            file_path,
-                            "-ar", str(sample_rate) , "-ac", "1", "-f", "s16le", "-"],
-                            stdout=subprocess.PIPE).stdout as stream:
-
-                with open(file_path_webvtt, 'w') as f:
-                    f.write(rec.SrtResult(stream))
-            
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-            # send pushover that this twitch vod is ready to edit
-            text = video['helix']['user_name'] + " vod " + str(video['helix']['id']) \
-                    + " ready to edit (" + str(int((time.time() - t0_start)/60.0)) + " min to prepare)"
-            utils.send_pushover_message(conf, text)
-
-        # RENDER: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_path_render = path_data + export_folder + filename_format + "_chat.mp4"
-        file_path_render_tmp = path_temp + str(video['helix']['id']) + "_chat.mp4"
-        if not utils.terminated_requested and os.path.exists(file_path_chat) and not os.path.exists(file_path_render) and render_chat[idx]:
-            print("\t- rendering chat: " + file_path_render)
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatrender' \
-                  + ' -i ' + file_path_chat + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' -h 926 -w 274 --update-rate 0.1 --framerate 60 --font-size 15' \
-                  + ' --temp-path "' + path_temp + '" -o ' + file_path_render_tmp
-            # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            subprocess.Popen(cmd, shell=True).wait()
-            if os.path.exists(file_path_render_tmp):
-                shutil.move(file_path_render_tmp, file_path_render) 
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-    # loop through each highlight and download
-    for video in arr_upload:
-
-        # check if we should download any more
-        if utils.terminated_requested:
-            print('terminate requested, not downloading any more..')
-            break
+def settled(job):
+    # archived as far as it can be, a vod with a known bad chat (most often there was no chat at all)
+    # is, the watermark moves past it and update_badchat keeps it on a list to try its chat again
+    for name in job.stages:
+        if job.state[name] == pipeline.DONE:
+            continue
+        if job.data.get('badchat') and name in chat_stages:
+            continue
+        return False
+    return True
+
+
+def update_watermarks(user, marks, jobs, live_video_id, newest_listed, log):
+    # everything up to the newest listed video is archived, unless a job of that type failed, then
+    # the watermark only moves up to the video before it so the failed one is tried again next run
+    # the live vod is still growing, it has to stay above the watermark too
+    if newest_listed is None:
+        return
+    barrier = newest_listed if live_video_id is None else live_video_id - 1
+    for video_type in video_types:
+        mark = barrier
+        for job in sorted(jobs, key=lambda job: int(job.data['helix']['id'])):
+            if job.data['helix']['type'] == video_type and not settled(job):
+                mark = int(job.data['helix']['id']) - 1
+                break
+        # only ever move forward, also past what an overlapping run saved since this one started
+        if marks[video_type] is not None and mark <= marks[video_type]:
+            continue
+        saved = watermarks.modify(str(user["id"]) + "/" + video_type,
+                                  lambda current: mark if current is None or mark > current else current)
+        log("\t- " + video_type + " watermark now " + str(saved))
+
+
+def update_badchat(user, jobs, gone):
+    # the ids below the watermark whose chat is still missing, next to the watermarks of the channel
+    bad = set(job.name for job in jobs if job.data.get('badchat'))
+    done = set(job.name for job in jobs if job.state.get('chat') == pipeline.DONE) | set(gone)
+    listed = set(watermarks.get(str(user["id"]) + "/badchat", []))
+    if bad <= listed and len(done & listed) == 0:
+        return
+    watermarks.modify(str(user["id"]) + "/badchat",
+                      lambda current: sorted((set(current or []) - done) | bad, key=int))
+
+
+def remove_chat_parts(video_id):
+    # the finished ranges of a chat download are only kept for as long as its vod might come back
+    for name in os.listdir(path_temp):
+        if name.startswith(str(video_id) + "_chat_part"):
+            os.remove(path_temp + name)
+
+
+def process_channel_safe(idx, user):
+    global webvtt_channels_left
+    # a failing channel shouldn't take the other workers down with it
+    try:
+        process_channel(idx, user)
+    except Exception as e:
+        utils.channel_logger(user["login"].lower())("ERR: " + str(e))
+    # once no remaining channel wants transcripts the model is just wasted memory
+    if render_webvtt[idx]:
+        with webvtt_lock:
+            webvtt_channels_left = webvtt_channels_left - 1
+            if webvtt_channels_left == 0:
+                model_cache.release()
 
-        # DATA: api data of this vod
-        t0_start = time.time()
-        video_data = {
-            'id': video['helix']['id'],
-            'user_id': video['helix']['user_id'],
-            'user_name': video['helix']['user_name'],
-            'title': video['helix']['title'],
-            'type': video['helix']['type'],
-            'duration': video['helix']['duration'],
-            'url': video['helix']['url'],
-            'views': video['helix']['view_count'],
-            'moments': utils.get_vod_moments(video['helix']['id']),
-            'muted_segments': (video['helix']['muted_segments'] if video['helix']['muted_segments'] != None else []),
-            'recorded_at': video['helix']['created_at'].strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'recorded_at_iso': video['helix']['created_at'].strftime('%Y%m%d T%H%M%SZ')
-        }
-
-        # providing a single source for all filename calls in this script, including stripping illegal characters
-        filename_format = utils.cleanFilename(str(video_data['recorded_at_iso']) + " - " + str(video['helix']['id']) + " - " + str(video['helix']['title']) + "_" + str(video['helix']['type']))
 
-        # extract what folder we should save into
-        # create the folder if it isn't created already
-        try:
-            date = datetime.strptime(video_data['recorded_at'], '%Y-%m-%dT%H:%M:%SZ')
-            export_folder = format(date.year, '02') + "-" + format(date.month, '02') + "/"
-        except:
-            export_folder = "unknown/"
-        if not os.path.exists(path_data + export_folder):
-            os.makedirs(path_data + export_folder)
-
-        # VIDEO: check if the file exists
-        file_path_info = path_data + export_folder + filename_format + "_info.json"
-        print("\t- saving video info: " + file_path_info)
-        if not utils.terminated_requested and not os.path.exists(file_path_info):
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_data, file, indent=4)
-        elif not utils.terminated_requested:
-            print("\t- updating video info: " + file_path_info)
-            with open(file_path_info) as f:
-                video_info = json.load(f)
-            # update moments if failed before
-            if len(video_info["moments"]) == 0:
-                moments = utils.get_vod_moments(video['helix']['id'])
-                if len(moments) != 0:
-                    video_info["moments"] = moments
-            # finally write to file
-            with open(file_path_info, 'w', encoding="utf-8") as file:
-                json.dump(video_info, file, indent=4)
-
-        # VIDEO: check if the file exists
-        file_path = path_data + export_folder + filename_format + ".mp4"
-        print("\t- download video: " + file_path)
-        if not utils.terminated_requested and not os.path.exists(file_path):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' videodownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' --temp-path "' + path_temp + '" -o "' + file_path + '"'
-            # print("CMD: " + str(cmd))
-            subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            # subprocess.Popen(cmd, shell=True).wait()
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # CHAT: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_bad = file_path_chat + ".BAD"
-        file_path_chat_tmp = path_temp + str(video['helix']['id']) + "_chat.json"
-        print("\t- download chat: " + file_path_chat)
-        if not utils.terminated_requested and (not os.path.exists(file_path_chat) or utils.checkBadChat(video['helix']['id'], "clips", badchat_log)):
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatdownload' \
-                  + ' --id ' + str(video['helix']['id']) + ' -E' \
-                  + ' -o ' + file_path_chat_tmp
-            # print("CMD: " + str(cmd))
-            # Attempt to download chat log. If the first attempt with emojis embedded fails, try again without emojis. TDCLI will error out
-            #   there's issues with downloading emojis. We'd rather download the log without them than fail entirely.
-            #
-            # If the no-emoji attempt fails as well, we'll assume there's no chat log at all for this video. We'll write a blank .BAD file
-            #   to satisfy future file-exists checks.
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            proc.wait()
-            if proc.returncode != 0:
-                print("ERR: Clip has no chat. Either nothing was said or the source VOD is no longer available. Inserting placeholder.")               
-                with open(badchat_log, 'a') as fp:
-                    fp.write(str(video['helix']['id']))
-                    fp.write('\n')
-            else:
-                print("GOOD: File moved")
-                if os.path.exists(file_path_chat_tmp):
-                    shutil.move(file_path_chat_tmp, file_path_chat)
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-        # AUDIO-TO-TEXT: check if file exists
-        file_path_webvtt = path_data + export_folder + filename_format + ".srt"
-        if not utils.terminated_requested and os.path.exists(file_path) and not os.path.exists(file_path_webvtt) and render_webvtt[idx]:
-            print("\t- transcribing: " + file_path_webvtt)
-            t0 = time.time()
-
-            # open the model
-            SetLogLevel(-1)
-            sample_rate = 16000
-            # words_per_line = 7
-            model = Model(path_model)
-            rec = KaldiRecognizer(model, sample_rate)
-            rec.SetWords(True)
-
-            with subprocess.Popen([ffmpeg_path, "-loglevel", "quiet", "-i",
-                            file_path,
-                            "-ar", str(sample_rate) , "-ac", "1", "-f", "s16le", "-"],
-                            stdout=subprocess.PIPE).stdout as stream:
-
-                with open(file_path_webvtt, 'w') as f:
-                    f.write(rec.SrtResult(stream))
-            
-            print("\t- done in " + str(time.time() - t0) + " seconds")
-
-            # send pushover that this twitch vod is ready to edit
-            text = video['helix']['user_name'] + " vod " + str(video['helix']['id']) \
-                    + " ready to edit (" + str(int((time.time() - t0_start)/60.0)) + " min to prepare)"
-            utils.send_pushover_message(conf, text)
-
-        # RENDER: check if the file exists
-        file_path_chat = path_data + export_folder + filename_format + "_chat.json"
-        file_path_render = path_data + export_folder + filename_format + "_chat.mp4"
-        file_path_render_tmp = path_temp + str(video['helix']['id']) + "_chat.mp4"
-        if not utils.terminated_requested and os.path.exists(file_path_chat) and not os.path.exists(file_path_render) and render_chat[idx]:
-            print("\t- rendering chat: " + file_path_render)
-            t0 = time.time()
-            cmd = path_twitch_cli + ' chatrender' \
-                  + ' -i ' + file_path_chat + ' --ffmpeg-path "' + ffmpeg_path + '"' \
-                  + ' -h 926 -w 274 --update-rate 0.1 --framerate 60 --font-size 15' \
-                  + ' --temp-path "' + path_temp + '" -o ' + file_path_render_tmp
-            # subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
-            subprocess.Popen(cmd, shell=True).wait()
-            if os.path.exists(file_path_render_tmp):
-                shutil.move(file_path_render_tmp, file_path_render) 
-            print("\t- done in " + str(time.time() - t0) + " seconds")
+# now lets loop through each user and make sure we have downloaded
+# their most recent VODs and if we have not, we should download them!
+video_pipeline = pipeline.Pipeline(stage_workers)
+webvtt_lock = threading.Lock()
+webvtt_channels_left = sum(1 for enabled in render_webvtt if enabled)
+with ThreadPoolExecutor(max_workers=max(1, channel_workers)) as executor:
+    futures = [executor.submit(process_channel_safe, idx, user) for idx, user in enumerate(users)]
+    for future in futures:
+        future.result()
+video_pipeline.shutdown()
+if utils.terminated_requested:
+    print('terminate requested, not looking at any more users...')
+archive.close()
+http_client.print_stats()